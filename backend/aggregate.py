@@ -0,0 +1,280 @@
+"""Vectorized bucketing and aggregation of filtered pick and task columns.
+
+Aggregation is split in two steps: `*_sums` reduces the rows of each
+period to additive sums, and `*_response` turns those sums into the
+per-period series and min/max envelope returned by the endpoints.
+
+Grouped queries reduce over (group, period) cells instead, so every sum is
+an (n_groups, n_periods) array and `grouped_response` builds one series
+per group.
+
+`*_sketches` adds quantile sketches (see sketch.py) of the values whose
+distribution is reported, which `quantile_sums` turns into per-period
+quantiles.
+"""
+
+import numpy as np
+
+from sketch import QUANTILES, Sketches
+
+
+INTERVALS = {"daily": "D", "weekly": "W", "monthly": "M"}
+
+WEIGHTS_OF_PICK_OBJECTS = {
+    "zucchini": 200,  # weight in grams
+    "avocado": 100,  # weight in grams
+}
+DEFAULT_PICK_WEIGHT = 150  # Default weight if not found
+
+# Fields reported with a min_/max_ envelope, with the value used when the
+# series is empty
+PICKS_ENVELOPE = (
+    ("mpph", 0),
+    ("total_duration", 0),
+    ("total_picks", 0),
+    ("tonnes", 0.0),
+    ("accumulated_total_duration", 0),
+    ("accumulated_picks", 0),
+    ("accumulated_tonnes", 0.0),
+)
+
+TASKS_ENVELOPE = (
+    ("total_tasks", 0),
+    ("total_duration", 0),
+    ("total_successful_picks_duration", 0),
+    ("total_successful_pick_count", 0),
+    ("total_unsuccessful_pick_count", 0),
+    ("accumulating_total_tasks", 0),
+    ("accumulating_total_duration", 0),
+    ("accumulating_total_successful_picks_duration", 0),
+    ("accumulating_total_successful_pick_count", 0),
+)
+
+
+def weights_by_code(objects):
+    """Weight in grams of each pick_object code of the objects dictionary."""
+    return np.array(
+        [WEIGHTS_OF_PICK_OBJECTS.get(name, DEFAULT_PICK_WEIGHT) for name in objects.values],
+        dtype=np.float64,
+    )
+
+
+def generate_intervals(interval, times, zone=None):
+    """Assign every timestamp to its period, of the local calendar of zone
+    (a zones.OffsetTable) when given and of UTC otherwise.
+
+    Returns the sorted unique periods and, for every row, the index of its
+    period in that array."""
+    if zone is not None:
+        times = zone.local(times.astype("datetime64[us]"))
+    dates = times.astype(f"datetime64[{INTERVALS[interval]}]")
+    unique_intervals, inverse = np.unique(dates, return_inverse=True)
+    return unique_intervals, inverse
+
+
+def segment_sum(inverse, n, values=None):
+    return np.bincount(inverse, weights=values, minlength=n).astype(np.float64)
+
+
+def pick_sums(columns, inverse, n, weights):
+    # PPH and durations are truncated to whole numbers before aggregating
+    return {
+        "rows": segment_sum(inverse, n),
+        "pph": segment_sum(inverse, n, np.trunc(columns["pph"])),
+        "duration": segment_sum(inverse, n, np.trunc(columns["duration"])),
+        "picks": segment_sum(inverse, n, columns["pph"] != 0),
+        "weight": segment_sum(inverse, n, weights[columns["pick_object"]]),
+    }
+
+
+def task_sums(columns, inverse, n):
+    # NULL durations are stored as NaN and count as zero
+    return {
+        "rows": segment_sum(inverse, n),
+        "duration": segment_sum(inverse, n, np.nan_to_num(columns["duration"])),
+        "successful_picks_duration": segment_sum(
+            inverse, n, np.nan_to_num(columns["successful_picks_duration"])
+        ),
+        "successful_pick_count": segment_sum(inverse, n, columns["successful_pick_count"]),
+        "unsuccessful_pick_count": segment_sum(
+            inverse, n, columns["unsuccessful_pick_count"]
+        ),
+    }
+
+
+def grouped_sums(summarize, columns, groups, inverse, n_groups, n_periods):
+    """Run summarize over (group, period) cells, given the group and period
+    index of every row, and return the sums as (n_groups, n_periods)
+    arrays."""
+    sums = summarize(columns, groups * n_periods + inverse, n_groups * n_periods)
+    return {name: values.reshape(n_groups, n_periods) for name, values in sums.items()}
+
+
+def pick_sketches(columns, inverse, n):
+    return {
+        "pph_sketch": Sketches.of_values(columns["pph"], inverse, n),
+        "duration_sketch": Sketches.of_values(columns["duration"], inverse, n),
+    }
+
+
+def task_sketches(columns, inverse, n):
+    # NULL durations are NaN and left out
+    return {"duration_sketch": Sketches.of_values(columns["duration"], inverse, n)}
+
+
+def merge_period_sums(parts):
+    """Combine several (periods, sums) pairs into one, adding up the sums of
+    periods that appear in more than one pair. Periods are the last axis of
+    the sums, so grouped sums merge the same way."""
+    if len(parts) == 1:
+        return parts[0]
+    unique_intervals = np.unique(np.concatenate([periods for periods, _ in parts]))
+    positions = [np.searchsorted(unique_intervals, periods) for periods, _ in parts]
+    sums = {}
+    for name, values in parts[0][1].items():
+        if isinstance(values, Sketches):
+            sketches = [part_sums[name] for _, part_sums in parts]
+            sums[name] = merge_period_sketches(
+                list(zip(sketches, positions)), len(unique_intervals)
+            )
+            continue
+        total = np.zeros(values.shape[:-1] + (len(unique_intervals),))
+        for (_, part_sums), part_positions in zip(parts, positions):
+            # Periods are unique within a part
+            total[..., part_positions] += part_sums[name]
+        sums[name] = total
+    return unique_intervals, sums
+
+
+def merge_period_sketches(parts, n_periods):
+    """Merge (sketches, positions) pairs, whose last axis is periods that
+    go to the given positions of n_periods periods."""
+    shape = parts[0][0].shape[:-1] + (n_periods,)
+    n_rows = int(np.prod(shape[:-1]))
+    return Sketches.merged(
+        [
+            (sketches, (np.arange(n_rows)[:, None] * n_periods + positions).ravel())
+            for sketches, positions in parts
+        ],
+        shape,
+    )
+
+
+def quantile_sums(sums):
+    """Replace every <name>_sketch in sums by <name>_<suffix> arrays of
+    the QUANTILES of its sketches."""
+    result = {}
+    for name, values in sums.items():
+        if not isinstance(values, Sketches):
+            result[name] = values
+            continue
+        quantiles = values.quantiles([q for _, q in QUANTILES])
+        for i, (suffix, _) in enumerate(QUANTILES):
+            result[f"{name.removesuffix('_sketch')}_{suffix}"] = quantiles[..., i]
+    return result
+
+
+def quantile_fields(sums, names):
+    # Quantiles of sketches without values are null. Six significant digits
+    # keep the rounding well below the error of the sketch.
+    return {
+        f"{name}_{suffix}": [
+            None if np.isnan(value) else float(f"{value:.6g}")
+            for value in sums[f"{name}_{suffix}"].tolist()
+        ]
+        for name in names
+        if f"{name}_p50" in sums
+        for suffix, _ in QUANTILES
+    }
+
+
+def rounded(values, precision):
+    return [float(f"{value:.{precision}f}") for value in values]
+
+
+def picks_fields(sums):
+    rows = sums["rows"]
+    mpph = np.rint(np.divide(sums["pph"], rows, out=np.zeros_like(rows), where=rows > 0))
+    total_duration = sums["duration"].astype(np.int64)
+    total_picks = sums["picks"].astype(np.int64)
+    tonnes = sums["weight"] / 1_000_000  # Convert grams to tonnes
+    return {
+        **quantile_fields(sums, ("pph", "duration")),
+        "mpph": mpph.astype(np.int64).tolist(),
+        "total_duration": total_duration.tolist(),
+        "total_picks": total_picks.tolist(),
+        "tonnes": rounded(tonnes.tolist(), 3),
+        "accumulated_total_duration": np.cumsum(total_duration).tolist(),
+        "accumulated_picks": np.cumsum(total_picks).tolist(),
+        "accumulated_tonnes": rounded(np.cumsum(tonnes).tolist(), 3),
+    }
+
+
+def tasks_fields(sums):
+    total_tasks = sums["rows"].astype(np.int64)
+    total_duration = [round(value, 2) for value in sums["duration"].tolist()]
+    total_successful_picks_duration = [
+        round(value, 2) for value in sums["successful_picks_duration"].tolist()
+    ]
+    successful_pick_count = sums["successful_pick_count"].astype(np.int64)
+    unsuccessful_pick_count = sums["unsuccessful_pick_count"].astype(np.int64)
+    return {
+        **quantile_fields(sums, ("duration",)),
+        "total_tasks": total_tasks.tolist(),
+        "total_duration": [int(value) for value in total_duration],
+        "total_successful_picks_duration": [
+            int(value) for value in total_successful_picks_duration
+        ],
+        "total_successful_pick_count": successful_pick_count.tolist(),
+        "total_unsuccessful_pick_count": unsuccessful_pick_count.tolist(),
+        "accumulating_total_tasks": np.cumsum(total_tasks).tolist(),
+        "accumulating_total_duration": np.cumsum(total_duration)
+        .astype(np.int64)
+        .tolist(),
+        "accumulating_total_successful_picks_duration": np.cumsum(
+            total_successful_picks_duration
+        )
+        .astype(np.int64)
+        .tolist(),
+        "accumulating_total_successful_pick_count": np.cumsum(
+            successful_pick_count
+        ).tolist(),
+        "accumulating_total_unsuccessful_pick_count": np.cumsum(
+            unsuccessful_pick_count
+        ).tolist(),
+    }
+
+
+def series_response(periods, fields, envelope):
+    """Build the {"series": {"date": [...], <field>: [...]}, "min_<field>":
+    ..., "max_<field>": ...} response from per-period field lists.
+
+    The series is kept as columns; see formats.py for the shapes it is
+    sent in."""
+    response = {"series": {"date": periods.astype(str).tolist(), **fields}}
+    for name, default in envelope:
+        response[f"min_{name}"] = min(fields[name], default=default)
+        response[f"max_{name}"] = max(fields[name], default=default)
+    return response
+
+
+def picks_response(periods, sums):
+    return series_response(periods, picks_fields(sums), PICKS_ENVELOPE)
+
+
+def tasks_response(periods, sums):
+    return series_response(periods, tasks_fields(sums), TASKS_ENVELOPE)
+
+
+def grouped_response(name, values, periods, sums, respond):
+    """Build {"groups": [{name: value, "series": ..., "min_<field>": ...},
+    ...]} from grouped sums, with respond(periods, sums) building the
+    response of each group from the periods it has rows in."""
+    groups = []
+    for group, value in enumerate(values):
+        present = sums["rows"][group] > 0
+        group_sums = {
+            field: field_sums[group][present] for field, field_sums in sums.items()
+        }
+        groups.append({name: value, **respond(periods[present], group_sums)})
+    return {"groups": groups}
@@ -0,0 +1,344 @@
+"""Benchmarks of the /picks and /tasks hot path on synthetic data.
+
+Generates a Dataset with the column layout `db.load_dataset` produces, runs
+the filtering, bucketing, aggregation and endpoint functions in-process over
+a matrix of date ranges, intervals and filters, and prints latency
+percentiles, rows/s and peak memory as JSON. No database is needed:
+
+    python bench.py --picks 1000000 --repeat 5 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from starlette.datastructures import URL, QueryParams
+
+import main
+from aggregate import INTERVALS, WEIGHTS_OF_PICK_OBJECTS, generate_intervals
+from executor import Aggregator
+from rollup import Rollup, summarize_picks, summarize_tasks
+from store import (
+    PICK_COLUMNS,
+    TASK_COLUMNS,
+    ColumnTable,
+    Dataset,
+    SegmentedTable,
+    StringDictionary,
+)
+
+
+# Date ranges ending at the newest row, as (name, days)
+RANGES = (("day", 1), ("week", 7), ("month", 30), ("year", 365), ("all", None))
+
+# robot_id / site / pick_object filters, as (name, which of them are set)
+FILTERS = (
+    ("all", ()),
+    ("robot", ("robot_id",)),
+    ("site_object", ("site", "pick_object")),
+)
+
+EPOCH = np.datetime64("2022-01-01T00:00:00", "us")
+
+
+def generate_dataset(n_picks, n_tasks, robots, sites, objects, days, seed=0):
+    """Build a Dataset of n_picks picks and n_tasks tasks spread uniformly
+    over days days, with the given number of robots, sites and objects."""
+    rng = np.random.default_rng(seed)
+    object_names = list(WEIGHTS_OF_PICK_OBJECTS)
+    object_names += [f"object-{i}" for i in range(objects - len(object_names))]
+    dictionaries = {
+        "robots": StringDictionary(
+            [None] + [f"{i:08x}-0000-4000-8000-000000000000" for i in range(robots)]
+        ),
+        "sites": StringDictionary([None] + [f"site-{i}" for i in range(sites)]),
+        "objects": StringDictionary([None] + object_names[:objects]),
+    }
+    span = days * 86_400_000_000
+
+    def times(n):
+        # Microseconds since EPOCH, ending mid-day so ranges ending at the
+        # newest row have a partial last day
+        return EPOCH + np.sort(rng.integers(0, span - 3_600_000_000 * 10, n))
+
+    def codes(n, size):
+        return rng.integers(1, size + 1, n, dtype=np.int32)
+
+    duration = rng.uniform(1.0, 5.0, n_picks)
+    picks = {
+        "start_pick_time_utc": times(n_picks),
+        "pick_object": codes(n_picks, objects),
+        "duration": duration,
+        "robot_id": codes(n_picks, robots),
+        "pph": 3600 / duration,
+        "site": codes(n_picks, sites),
+        "id": np.arange(1, n_picks + 1),
+    }
+    del duration
+
+    successful = rng.integers(0, 20, n_tasks, dtype=np.int32)
+    task_duration = rng.uniform(10.0, 600.0, n_tasks)
+    # Tasks that never ended, and tasks without a known pick object
+    task_duration[rng.random(n_tasks) < 0.05] = np.nan
+    pick_object = codes(n_tasks, objects)
+    pick_object[rng.random(n_tasks) < 0.05] = 0
+    tasks = {
+        "pick_object": pick_object,
+        "success": rng.random(n_tasks) < 0.7,
+        "duration": task_duration,
+        "successful_picks_duration": successful * rng.uniform(1.0, 5.0, n_tasks),
+        "successful_pick_count": successful,
+        "unsuccessful_pick_count": rng.integers(0, 5, n_tasks, dtype=np.int32),
+        "start_date_utc": times(n_tasks),
+        "id": np.arange(1, n_tasks + 1),
+        "robot_id": codes(n_tasks, robots),
+        "site": codes(n_tasks, sites),
+    }
+
+    picks = SegmentedTable(
+        ColumnTable(PICK_COLUMNS, picks, "start_pick_time_utc", dictionaries)
+    )
+    tasks = SegmentedTable(
+        ColumnTable(TASK_COLUMNS, tasks, "start_date_utc", dictionaries)
+    )
+    # Metadata rows shaped like those of db.fetch_metadata
+    robot_rows = [
+        (robot_id, f"robot-{i}")
+        for i, robot_id in enumerate(dictionaries["robots"].values[1:])
+    ]
+    return Dataset(
+        dictionaries,
+        picks,
+        tasks,
+        np.array(robot_rows),
+        np.array([(site,) for site in dictionaries["sites"].values[1:]]),
+        np.array([(name,) for name in dictionaries["objects"].values[1:]]),
+        n_picks,
+        n_tasks,
+        picks_rollup=Rollup.build(
+            picks.base.columns, "start_pick_time_utc", summarize_picks(dictionaries)
+        ),
+        tasks_rollup=Rollup.build(
+            tasks.base.columns, "start_date_utc", summarize_tasks(dictionaries)
+        ),
+    )
+
+
+class IdleRequest:
+    """Stands in for the Request of an endpoint whose client never leaves."""
+
+    headers = {}
+    query_params = QueryParams()
+    url = URL("/")
+
+    async def receive(self):
+        await asyncio.Event().wait()
+
+
+def bounds(dataset, days):
+    newest = dataset.picks.base.columns["start_pick_time_utc"][-1]
+    upper = newest.astype(datetime).replace(tzinfo=timezone.utc)
+    if days is None:
+        return datetime(2000, 1, 1, tzinfo=timezone.utc), upper
+    return upper - timedelta(days=days), upper
+
+
+def filter_values(dataset, names):
+    values = {"robot_id": ["all"], "site": ["all"], "pick_object": ["all"]}
+    for name in names:
+        # The most common value of the column, decoded
+        table = dataset.picks.base
+        code = np.bincount(table.columns[name]).argmax()
+        values[name] = [table.encodings[name].decode(code)]
+    return values
+
+
+def measure(function, repeat):
+    """Run function repeat times, then once more under tracemalloc.
+
+    Returns (seconds per run, peak bytes traced during the extra run)."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return samples, peak
+
+
+def summary(samples, peak, rows):
+    p50, p90, p99 = np.percentile(samples, (50, 90, 99)) * 1000
+    return {
+        "rows": rows,
+        "runs": len(samples),
+        "mean_ms": round(float(np.mean(samples)) * 1000, 3),
+        "p50_ms": round(float(p50), 3),
+        "p90_ms": round(float(p90), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(max(samples) * 1000, 3),
+        "rows_per_sec": round(rows / float(np.median(samples))) if rows else None,
+        "peak_traced_mb": round(peak / 2**20, 3),
+    }
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_benchmarks(dataset, repeat):
+    main.dataset = dataset
+    loop = asyncio.new_event_loop()
+    # One worker and no timeout, so endpoint timings are single queries
+    main.aggregator = Aggregator("thread", 1, 0)
+    endpoints = {"picks": main.read_mpph, "tasks": main.read_tasks}
+    computes = {"picks": main.compute_picks, "tasks": main.compute_tasks}
+    filters = {"picks": main.filter_picks_data, "tasks": main.filter_tasks_data}
+    time_columns = {"picks": "start_pick_time_utc", "tasks": "start_date_utc"}
+
+    results = []
+    for range_name, days in RANGES:
+        lower, upper = bounds(dataset, days)
+        for table in ("picks", "tasks"):
+            (lo, hi), _ = getattr(dataset, table).time_ranges(
+                main.to_utc_datetime64(lower), main.to_utc_datetime64(upper)
+            )
+            rows = int(hi - lo)
+
+            def result(name, samples, peak, **case):
+                results.append(
+                    {"name": name, "table": table, "range": range_name, **case}
+                    | summary(samples, peak, rows)
+                )
+
+            # No robot, site or object filter
+            everything = (("all",), ("all",), ("all",))
+            times = filters[table](dataset, lower, upper, *everything)[
+                time_columns[table]
+            ]
+            for interval in INTERVALS:
+                samples, peak = measure(
+                    lambda: generate_intervals(interval, times), repeat
+                )
+                result("generate_intervals", samples, peak, interval=interval)
+
+            for filter_name, names in FILTERS:
+                values = filter_values(dataset, names)
+                args = (values["robot_id"], values["site"], values["pick_object"])
+                samples, peak = measure(
+                    lambda: filters[table](dataset, lower, upper, *args), repeat
+                )
+                result(f"filter_{table}_data", samples, peak, filter=filter_name)
+
+                for interval in INTERVALS:
+                    samples, peak = measure(
+                        lambda: computes[table](
+                            dataset, lower, upper, interval, *args
+                        ),
+                        repeat,
+                    )
+                    result(
+                        computes[table].__name__,
+                        samples,
+                        peak,
+                        interval=interval,
+                        filter=filter_name,
+                    )
+
+                    def request():
+                        # Every request misses the response cache
+                        main.response_cache.clear()
+                        loop.run_until_complete(
+                            endpoints[table](
+                                IdleRequest(), lower, upper, interval, *args
+                            )
+                        )
+
+                    samples, peak = measure(request, repeat)
+                    result(
+                        endpoints[table].__name__,
+                        samples,
+                        peak,
+                        interval=interval,
+                        filter=filter_name,
+                    )
+
+            # The series of every robot from one grouped query, periods of a
+            # local calendar with daylight saving time, and quantiles
+            for options in (
+                {"group_by": "robot_id"},
+                {"tz": "Europe/Berlin"},
+                {"quantiles": True},
+            ):
+                for interval in INTERVALS:
+                    samples, peak = measure(
+                        lambda: computes[table](
+                            dataset, lower, upper, interval, *everything, **options
+                        ),
+                        repeat,
+                    )
+                    result(
+                        computes[table].__name__,
+                        samples,
+                        peak,
+                        interval=interval,
+                        filter="all",
+                        **options,
+                    )
+
+    main.aggregator.close()
+    loop.close()
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--picks", type=int, default=1_000_000)
+    parser.add_argument("--tasks", type=int, help="defaults to picks / 4")
+    parser.add_argument("--robots", type=int, default=50)
+    parser.add_argument("--sites", type=int, default=10)
+    parser.add_argument("--objects", type=int, default=20)
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    n_tasks = args.picks // 4 if args.tasks is None else args.tasks
+    # The pick weights only know zucchini and avocado, keep both in play
+    objects = max(args.objects, len(WEIGHTS_OF_PICK_OBJECTS))
+
+    started = time.perf_counter()
+    dataset = generate_dataset(
+        args.picks, n_tasks, args.robots, args.sites, objects, args.days, args.seed
+    )
+    generate_seconds = time.perf_counter() - started
+
+    report = {
+        "config": vars(args) | {"tasks": n_tasks, "objects": objects},
+        "dataset": {
+            "picks": len(dataset.picks),
+            "tasks": len(dataset.tasks),
+            "generate_seconds": round(generate_seconds, 3),
+            "max_rss_mb": max_rss_mb(),
+        },
+        "results": run_benchmarks(dataset, args.repeat),
+        "max_rss_mb": max_rss_mb(),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main_cli()
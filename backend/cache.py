@@ -0,0 +1,103 @@
+"""LRU/TTL cache of rendered responses with coalescing of identical requests."""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Caches response bodies (bytes) per key within a memory budget.
+
+    Entries belong to one dataset generation: the first request for a newer
+    generation empties the cache, and results computed for an older one are
+    returned but not stored. Concurrent requests for a key that is being
+    computed for the same generation wait for that computation instead of
+    starting their own, and the computation is cancelled once every request
+    waiting for it is gone."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, body)
+        self.pending = {}  # (key, generation) -> task computing the body
+        self.waiters = {}  # (key, generation) -> requests waiting for that task
+        self.size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key, generation, compute):
+        """Return the cached body for key, or await compute() for it."""
+        if generation > self.generation:
+            self.clear()
+            self.generation = generation
+
+        # Entries are all of the newest generation
+        entry = self.entries.get(key) if generation == self.generation else None
+        if entry is not None:
+            expires, body = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return body
+            self.remove(key)
+
+        # A computation for another generation would send its body under the
+        # ETag of this one
+        pending_key = (key, generation)
+        task = self.pending.get(pending_key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self.pending[pending_key] = task
+            task.add_done_callback(lambda task: self.finish(key, generation, task))
+        else:
+            self.coalesced += 1
+        self.waiters[pending_key] = self.waiters.get(pending_key, 0) + 1
+        try:
+            # A waiter going away must not cancel the computation for the others
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[pending_key] -= 1
+            if not self.waiters[pending_key]:
+                del self.waiters[pending_key]
+                if not task.done():
+                    del self.pending[pending_key]
+                    task.cancel()
+
+    def finish(self, key, generation, task):
+        if self.pending.get((key, generation)) is task:
+            del self.pending[(key, generation)]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if generation == self.generation:
+            self.put(key, task.result())
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        while self.entries and self.size + len(body) > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+        self.entries[key] = (time.monotonic() + self.ttl, body)
+        self.size += len(body)
+
+    def remove(self, key):
+        _, body = self.entries.pop(key)
+        self.size -= len(body)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
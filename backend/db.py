@@ -0,0 +1,758 @@
+"""Postgres access: the connection pool and the queries behind the dataset
+and the sync log."""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
+
+from metrics import span
+from rollup import Rollup, summarize_picks, summarize_tasks
+from store import (
+    PICK_COLUMNS,
+    TASK_COLUMNS,
+    ColumnBuilder,
+    ColumnTable,
+    Dataset,
+    SegmentedTable,
+    new_dictionaries,
+)
+
+
+# Rows per round trip of the server-side cursors the pick and task queries
+# are read through, and seconds between progress messages while loading
+FETCH_BATCH_SIZE = 50_000
+PROGRESS_INTERVAL = 10
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class ConnectionPool:
+    """A bounded pool of psycopg2 connections shared by all endpoints.
+
+    Unlike ThreadedConnectionPool on its own, `connection` waits for a free
+    connection instead of failing when all of them are in use. Connections
+    are blocking, so use them from worker threads, not the event loop."""
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self.available = threading.BoundedSemaphore(maxconn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, committing on success and rolling back on error."""
+        self.available.acquire()
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            yield conn
+            conn.commit()
+        except Exception:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn, close=bool(conn.closed))
+            self.available.release()
+
+    def close(self):
+        self.pool.closeall()
+
+
+# Any key, as long as it is the same in every worker. Robot ids are hashed
+# into the second key of the advisory lock.
+SYNC_LOCK = 7_402_115
+
+
+class RobotLocks:
+    """Postgres advisory locks on robot ids, so that no two worker processes
+    sync one robot at the same time.
+
+    They are session locks on one dedicated connection, as a sync holds its
+    lock for minutes and must not keep a pooled connection that long. Locks
+    taken on a connection that is lost are released with it. Use them from
+    worker threads, not the event loop."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.conn = None
+        self.mutex = threading.Lock()
+
+    def try_lock(self, robot_id):
+        """Take the lock on robot_id and return True, or return False if
+        another session holds it."""
+        with self.mutex:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(**self.kwargs)
+                self.conn.autocommit = True
+            cur = self.conn.cursor()
+            cur.execute(
+                "SELECT pg_try_advisory_lock(%s, hashtext(%s))", (SYNC_LOCK, robot_id)
+            )
+            locked = cur.fetchone()[0]
+            cur.close()
+            return locked
+
+    def unlock(self, robot_id):
+        with self.mutex:
+            if self.conn is None or self.conn.closed:
+                return
+            cur = self.conn.cursor()
+            cur.execute(
+                "SELECT pg_advisory_unlock(%s, hashtext(%s))", (SYNC_LOCK, robot_id)
+            )
+            cur.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+# Picks with an id in (picks_after, picks_upto]
+PICKS_QUERY = """
+SELECT
+    p.start_pick_time AT TIME ZONE 'UTC' as start_pick_time_utc,
+    p.pick_object,
+    EXTRACT(EPOCH FROM (p.end_pick_time - p.start_pick_time)) as duration,
+    e.robot_id,
+    3600 / EXTRACT(EPOCH FROM (p.end_pick_time - p.start_pick_time)) as pph,
+    e.description,
+    p.id
+FROM execution_data_pick p
+JOIN execution_data_task t ON p.task_id = t.id
+JOIN execution_data_run r ON t.run_id = r.id
+JOIN execution_data_experiment e ON r.experiment_id = e.id
+WHERE EXTRACT(EPOCH FROM (p.end_pick_time - p.start_pick_time)) > 0
+AND extract(EPOCH from (p.end_pick_time - p.start_pick_time)) <= 5
+AND extract(EPOCH from (p.end_pick_time - p.start_pick_time)) > 1
+AND p.failure_state = 'succeeded'
+AND p.id > %(picks_after)s
+AND p.id <= %(picks_upto)s;
+"""
+
+# Per-task pick aggregates maintained by refresh_task_aggregates, so that
+# loading tasks does not regroup the whole pick history. A task has one row in
+# dashboard_task_pick_objects per distinct object it picked, and is loaded
+# once per object. dashboard_task_aggregates_state holds the pick and task
+# ids the aggregates are complete up to, and the pending marks that become
+# complete once every transaction in progress when they were taken, all with
+# an xid below pending_xmax, has ended.
+#
+# To rebuild the aggregates from scratch, reset the state row:
+#
+#   UPDATE dashboard_task_aggregates_state SET picks_upto = 0, tasks_upto = 0,
+#       pending_picks_upto = NULL, pending_tasks_upto = NULL, pending_xmax = NULL;
+#
+# The next refresh then recomputes the aggregates of every task, and datasets
+# loaded after it see the rebuilt aggregates.
+TASK_AGGREGATES_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS dashboard_task_aggregates (
+        task_id integer PRIMARY KEY,
+        successful_pick_count integer NOT NULL,
+        successful_picks_duration interval,
+        unsuccessful_pick_count integer NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dashboard_task_pick_objects (
+        task_id integer NOT NULL,
+        pick_object text NOT NULL,
+        PRIMARY KEY (task_id, pick_object)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dashboard_task_aggregates_state (
+        picks_upto bigint NOT NULL,
+        tasks_upto bigint NOT NULL
+    )
+    """,
+    """
+    ALTER TABLE dashboard_task_aggregates_state
+    ADD COLUMN IF NOT EXISTS pending_picks_upto bigint,
+    ADD COLUMN IF NOT EXISTS pending_tasks_upto bigint,
+    ADD COLUMN IF NOT EXISTS pending_xmax bigint
+    """,
+    """
+    INSERT INTO dashboard_task_aggregates_state (picks_upto, tasks_upto)
+    SELECT 0, 0 WHERE NOT EXISTS (SELECT FROM dashboard_task_aggregates_state)
+    """,
+)
+
+# Indexes the task aggregates are built with, as (name, table, columns). They
+# are built CONCURRENTLY, so robot restores keep inserting while they build.
+TASK_AGGREGATES_INDEXES = (
+    (
+        "execution_data_pick_task_id_failure_state_idx",
+        "execution_data_pick",
+        "task_id, failure_state",
+    ),
+    (
+        "execution_data_pick_start_pick_time_idx",
+        "execution_data_pick",
+        "start_pick_time",
+    ),
+    ("execution_data_task_start_date_idx", "execution_data_task", "start_date"),
+)
+
+# Any keys, as long as they are the same in every worker
+TASK_AGGREGATES_LOCK = 7_402_113
+TASK_AGGREGATES_INDEX_LOCK = 7_402_114
+
+DELETE_TASK_AGGREGATES = """
+WITH selected_tasks AS ({selected_tasks})
+DELETE FROM {table} WHERE task_id IN (SELECT id FROM selected_tasks);
+"""
+
+INSERT_TASK_AGGREGATES = """
+WITH selected_tasks AS ({selected_tasks})
+INSERT INTO dashboard_task_aggregates
+SELECT
+    t.id,
+    COALESCE(sp.successful_pick_count, 0),
+    sp.successful_picks_duration,
+    COALESCE(up.unsuccessful_pick_count, 0)
+FROM
+    execution_data_task t
+JOIN
+    selected_tasks s ON t.id = s.id
+LEFT JOIN
+    (SELECT
+        task_id,
+        COUNT(*) AS successful_pick_count,
+        SUM(end_pick_time - start_pick_time) AS successful_picks_duration
+     FROM
+        execution_data_pick
+     WHERE
+        failure_state = 'succeeded'
+        AND end_pick_time IS NOT NULL
+        AND task_id IN (SELECT id FROM selected_tasks)
+     GROUP BY
+        task_id
+    ) AS sp ON t.id = sp.task_id
+LEFT JOIN
+    (SELECT
+        task_id,
+        COUNT(*) AS unsuccessful_pick_count
+     FROM
+        execution_data_pick
+     WHERE
+        failure_state <> 'succeeded'
+        AND task_id IN (SELECT id FROM selected_tasks)
+     GROUP BY
+        task_id
+    ) AS up ON t.id = up.task_id;
+"""
+
+INSERT_TASK_PICK_OBJECTS = """
+WITH selected_tasks AS ({selected_tasks})
+INSERT INTO dashboard_task_pick_objects
+SELECT DISTINCT task_id, pick_object
+FROM execution_data_pick
+WHERE pick_object IS NOT NULL AND task_id IN (SELECT id FROM selected_tasks);
+"""
+
+# Tasks, with their pick aggregates, whose id is returned by the
+# {selected_tasks} subquery. A task without an aggregates row yet is loaded
+# as having no picks.
+TASKS_QUERY = """
+WITH selected_tasks AS ({selected_tasks})
+SELECT
+    o.pick_object,
+    t.success,
+    EXTRACT(EPOCH FROM (t.end_date - t.start_date)) as duration,
+    EXTRACT(EPOCH FROM a.successful_picks_duration) AS successful_picks_duration,
+    COALESCE(a.successful_pick_count, 0) AS successful_pick_count,
+    COALESCE(a.unsuccessful_pick_count, 0) AS unsuccessful_pick_count,
+    t.start_date AT TIME ZONE 'UTC' as start_date_utc,
+    t.id,
+    e.robot_id,
+    e.description
+FROM
+    execution_data_task t
+JOIN
+    selected_tasks s ON t.id = s.id
+LEFT JOIN
+    dashboard_task_aggregates a ON t.id = a.task_id
+JOIN
+    execution_data_run r ON t.run_id = r.id
+JOIN
+    execution_data_experiment e ON r.experiment_id = e.id
+LEFT JOIN
+    dashboard_task_pick_objects o ON t.id = o.task_id;
+"""
+
+ALL_TASKS = "SELECT id FROM execution_data_task WHERE id <= %(tasks_upto)s"
+
+# New tasks plus the tasks that received new picks
+CHANGED_TASKS = """
+SELECT id FROM execution_data_task
+WHERE id > %(tasks_after)s AND id <= %(tasks_upto)s
+UNION
+SELECT task_id FROM execution_data_pick
+WHERE id > %(picks_after)s AND id <= %(picks_upto)s
+"""
+
+
+def fetch_high_water_marks(cur):
+    """Return the largest pick and task ids, and the xmin and xmax of a
+    snapshot taken after them."""
+    cur.execute(
+        """
+        SELECT
+            (SELECT COALESCE(MAX(id), 0) FROM execution_data_pick),
+            (SELECT COALESCE(MAX(id), 0) FROM execution_data_task);
+        """
+    )
+    picks_upto, tasks_upto = cur.fetchone()
+    # Ids are drawn when a row is inserted, not when it commits, so rows with
+    # lower ids can still be committed by the transactions in progress here
+    cur.execute(
+        """
+        SELECT
+            pg_snapshot_xmin(s)::text::bigint,
+            pg_snapshot_xmax(s)::text::bigint
+        FROM pg_current_snapshot() AS s;
+        """
+    )
+    return (picks_upto, tasks_upto, *cur.fetchone())
+
+
+def ensure_task_aggregates(conn):
+    """Create the task aggregate tables."""
+    cur = conn.cursor()
+    # Workers starting together would race on CREATE ... IF NOT EXISTS
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (TASK_AGGREGATES_LOCK,))
+    for statement in TASK_AGGREGATES_SCHEMA:
+        cur.execute(statement)
+    cur.close()
+    conn.commit()
+
+
+def ensure_task_aggregate_indexes(conn):
+    """Create the indexes the task aggregates are built with, unless another
+    worker is creating them.
+
+    CREATE INDEX CONCURRENTLY cannot run in a transaction, so conn is in
+    autocommit mode meanwhile. A build that was interrupted leaves an
+    invalid index behind, which is dropped and built again."""
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (TASK_AGGREGATES_INDEX_LOCK,))
+        if not cur.fetchone()[0]:
+            return
+        try:
+            for name, table, columns in TASK_AGGREGATES_INDEXES:
+                cur.execute(
+                    """
+                    SELECT FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE c.relname = %s AND NOT i.indisvalid
+                    """,
+                    (name,),
+                )
+                if cur.fetchone() is not None:
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                logger.info("Creating index %s unless it exists", name)
+                cur.execute(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}"
+                    f" ON {table} ({columns})"
+                )
+        finally:
+            cur.execute(
+                "SELECT pg_advisory_unlock(%s)", (TASK_AGGREGATES_INDEX_LOCK,)
+            )
+    finally:
+        cur.close()
+        conn.autocommit = False
+
+
+def refresh_task_aggregates(conn):
+    """Recompute the aggregates of the tasks added, or given new picks, since
+    the ids the aggregates are complete up to.
+
+    Returns the (picks, tasks) ids the aggregates are now complete up to,
+    and the (picks, tasks) high-water marks they cover, which are higher
+    while transactions that can still commit lower ids are in progress.
+    Concurrent refreshes wait for each other on the state row."""
+    with span("query.task_aggregates"):
+        return update_task_aggregates(conn)
+
+
+def update_task_aggregates(conn):
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT picks_upto, tasks_upto, pending_picks_upto, pending_tasks_upto,
+            pending_xmax
+        FROM dashboard_task_aggregates_state FOR UPDATE
+        """
+    )
+    picks_after, tasks_after, pending_picks, pending_tasks, pending_xmax = (
+        cur.fetchone()
+    )
+    picks_upto, tasks_upto, xmin, xmax = fetch_high_water_marks(cur)
+    if picks_upto == picks_after and tasks_upto == tasks_after:
+        cur.close()
+        conn.commit()
+        return picks_after, tasks_after, picks_upto, tasks_upto
+
+    # Everything past the complete marks is recomputed, as rows below the
+    # high-water marks may have been committed since the last refresh
+    params = {
+        "picks_after": picks_after,
+        "picks_upto": picks_upto,
+        "tasks_after": tasks_after,
+        "tasks_upto": tasks_upto,
+    }
+    for table in ("dashboard_task_aggregates", "dashboard_task_pick_objects"):
+        cur.execute(
+            DELETE_TASK_AGGREGATES.format(selected_tasks=CHANGED_TASKS, table=table),
+            params,
+        )
+    cur.execute(INSERT_TASK_AGGREGATES.format(selected_tasks=CHANGED_TASKS), params)
+    cur.execute(INSERT_TASK_PICK_OBJECTS.format(selected_tasks=CHANGED_TASKS), params)
+
+    # A pending mark is complete once no transaction that was in progress
+    # when it was taken can commit anymore
+    picks_complete, tasks_complete = picks_after, tasks_after
+    if pending_xmax is not None and xmin >= pending_xmax:
+        picks_complete, tasks_complete = pending_picks, pending_tasks
+        pending_xmax = None
+    if pending_xmax is None:
+        pending_picks, pending_tasks, pending_xmax = picks_upto, tasks_upto, xmax
+        if xmin >= xmax:
+            # No other transaction is in progress
+            picks_complete, tasks_complete = picks_upto, tasks_upto
+    if (picks_complete, tasks_complete) == (pending_picks, pending_tasks):
+        pending_picks = pending_tasks = pending_xmax = None
+    cur.execute(
+        """
+        UPDATE dashboard_task_aggregates_state
+        SET picks_upto = %s, tasks_upto = %s, pending_picks_upto = %s,
+            pending_tasks_upto = %s, pending_xmax = %s
+        """,
+        (picks_complete, tasks_complete, pending_picks, pending_tasks, pending_xmax),
+    )
+    cur.close()
+    conn.commit()
+    return picks_complete, tasks_complete, picks_upto, tasks_upto
+
+
+def fetch_columns(conn, name, query, params, schema, dictionaries):
+    """Run query on a server-side cursor and decode its rows into typed
+    columns one batch at a time, so the full result never exists as Python
+    tuples."""
+    with span(f"query.{name}") as stage:
+        cur = conn.cursor(name=f"dashboard_{name}")
+        cur.execute(query, params)
+        builder = ColumnBuilder(schema, dictionaries)
+        started = last_progress = time.monotonic()
+        while rows := cur.fetchmany(FETCH_BATCH_SIZE):
+            builder.append(rows)
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL:
+                logger.info(
+                    "Loading %s: %d rows (%.0f rows/s)",
+                    name,
+                    len(builder),
+                    len(builder) / (now - started),
+                )
+                last_progress = now
+        cur.close()
+        stage.rows = len(builder)
+
+    elapsed = time.monotonic() - started
+    if len(builder) >= FETCH_BATCH_SIZE:
+        logger.info(
+            "Loaded %d %s in %.1fs (%.0f rows/s)",
+            len(builder),
+            name,
+            elapsed,
+            len(builder) / elapsed,
+        )
+    return builder.finish()
+
+
+def fetch_metadata(cur):
+    # Fetch robots
+    cur.execute(
+        """
+        SELECT * FROM execution_data_robot;
+        """
+    )
+    robots = np.array(cur.fetchall())
+
+    cur.execute(
+        """
+        SELECT DISTINCT description FROM execution_data_experiment;
+        """
+    )
+    sites = np.array(cur.fetchall())
+
+    cur.execute(
+        """
+        SELECT DISTINCT pick_object FROM execution_data_pick;
+        """
+    )
+    objects = np.array(cur.fetchall())
+    return robots, sites, objects
+
+
+def load_dataset(conn):
+    """Load the full pick and task history."""
+    picks_complete, tasks_complete, picks_upto, tasks_upto = (
+        refresh_task_aggregates(conn)
+    )
+    params = {"picks_after": 0, "picks_upto": picks_upto, "tasks_upto": tasks_upto}
+
+    # robot_id, site and pick_object codes are shared between picks and tasks
+    dictionaries = new_dictionaries()
+
+    # Fetch picks data with robot_id
+    picks = fetch_columns(
+        conn, "picks", PICKS_QUERY, params, PICK_COLUMNS, dictionaries
+    )
+    picks = SegmentedTable(
+        ColumnTable(PICK_COLUMNS, picks, "start_pick_time_utc", dictionaries)
+    )
+
+    # Fetch tasks data with robot_id
+    tasks = fetch_columns(
+        conn,
+        "tasks",
+        TASKS_QUERY.format(selected_tasks=ALL_TASKS),
+        params,
+        TASK_COLUMNS,
+        dictionaries,
+    )
+    tasks = SegmentedTable(
+        ColumnTable(TASK_COLUMNS, tasks, "start_date_utc", dictionaries)
+    )
+
+    with span("query.metadata"):
+        cur = conn.cursor()
+        robots, sites, objects = fetch_metadata(cur)
+        cur.close()
+    conn.rollback()
+    return Dataset(
+        dictionaries,
+        picks,
+        tasks,
+        robots,
+        sites,
+        objects,
+        picks_upto,
+        tasks_upto,
+        picks_complete_mark=picks_complete,
+        tasks_complete_mark=tasks_complete,
+        picks_rollup=Rollup.build(
+            picks.base.columns, "start_pick_time_utc", summarize_picks(dictionaries)
+        ),
+        tasks_rollup=Rollup.build(
+            tasks.base.columns, "start_date_utc", summarize_tasks(dictionaries)
+        ),
+    )
+
+
+def refresh_dataset(conn, dataset):
+    """Return a new Dataset with the picks and tasks added since dataset was
+    loaded, or dataset itself if nothing changed.
+
+    Only new picks are fetched, and only the aggregates of new tasks and of
+    tasks that received new picks are recomputed. Ids are used as high-water
+    marks because /sync restores robot history, so new rows can have pick
+    and task times in the past. Ids are drawn at insert and not at commit,
+    so the rows past the ids dataset is complete up to are fetched again and
+    replace the ones loaded before, until no transaction that can still
+    commit a lower id is in progress."""
+    picks_complete, tasks_complete, picks_upto, tasks_upto = (
+        refresh_task_aggregates(conn)
+    )
+    if (
+        picks_upto == dataset.picks_complete_mark
+        and tasks_upto == dataset.tasks_complete_mark
+    ):
+        return dataset
+
+    params = {
+        "picks_after": dataset.picks_complete_mark,
+        "picks_upto": picks_upto,
+        "tasks_after": dataset.tasks_complete_mark,
+        "tasks_upto": tasks_upto,
+    }
+    dictionaries = dataset.dictionaries
+
+    new_picks = fetch_columns(
+        conn, "picks", PICKS_QUERY, params, PICK_COLUMNS, dictionaries
+    )
+    replaced_picks = dataset.picks.matching("id", new_picks["id"])
+    changed_tasks = fetch_columns(
+        conn,
+        "tasks",
+        TASKS_QUERY.format(selected_tasks=CHANGED_TASKS),
+        params,
+        TASK_COLUMNS,
+        dictionaries,
+    )
+    replaced_tasks = dataset.tasks.matching("id", changed_tasks["id"])
+
+    with span("query.metadata"):
+        cur = conn.cursor()
+        robots, sites, objects = fetch_metadata(cur)
+        cur.close()
+    conn.rollback()
+
+    # Add the new rows to the rollups and take out the replaced rows
+    summarize = summarize_picks(dictionaries)
+    picks_rollup = dataset.picks_rollup.combine(
+        Rollup.build(new_picks, "start_pick_time_utc", summarize)
+    ).combine(Rollup.build(replaced_picks, "start_pick_time_utc", summarize), sign=-1)
+    summarize = summarize_tasks(dictionaries)
+    tasks_rollup = dataset.tasks_rollup.combine(
+        Rollup.build(changed_tasks, "start_date_utc", summarize)
+    ).combine(Rollup.build(replaced_tasks, "start_date_utc", summarize), sign=-1)
+
+    return Dataset(
+        dictionaries,
+        dataset.picks.upsert(new_picks, key="id"),
+        dataset.tasks.upsert(changed_tasks, key="id"),
+        robots,
+        sites,
+        objects,
+        picks_upto,
+        tasks_upto,
+        dataset.generation + 1,
+        picks_rollup,
+        tasks_rollup,
+        {
+            "picks": earliest(
+                np.concatenate(
+                    (
+                        new_picks["start_pick_time_utc"],
+                        replaced_picks["start_pick_time_utc"],
+                    )
+                )
+            ),
+            "tasks": earliest(
+                np.concatenate(
+                    (changed_tasks["start_date_utc"], replaced_tasks["start_date_utc"])
+                )
+            ),
+        },
+        picks_complete_mark=picks_complete,
+        tasks_complete_mark=tasks_complete,
+    )
+
+
+def earliest(times):
+    """The earliest of times, or None if there are none."""
+    times = times[~np.isnat(times)]
+    return times.min() if len(times) else None
+
+
+def fetch_last_syncs(conn, robot_ids):
+    """Return robot_id -> most recent sync_log end_date for the given robots."""
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT robot_id, MAX(end_date) FROM sync_log
+        WHERE robot_id = ANY(%s)
+        GROUP BY robot_id;
+        """,
+        (list(robot_ids),),
+    )
+    last_syncs = dict(cur.fetchall())
+    cur.close()
+    return last_syncs
+
+
+def fetch_last_successful_sync(conn, robot_id):
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT MAX(end_date) FROM sync_log WHERE robot_id = %s AND status = 'success'",
+        (robot_id,),
+    )
+    last_sync_end_date = cur.fetchone()[0]
+    cur.close()
+    return last_sync_end_date
+
+
+def insert_sync_log(conn, robot_id, address, start_date, end_date, status, message):
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO sync_log (robot_id, address, start_date, end_date, status, message)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """,
+        (robot_id, address, start_date, end_date, status, message),
+    )
+    cur.close()
+
+
+# Fleet sync jobs, readable by every worker process whichever one runs them.
+# job holds everything /sync/jobs/{job_id} returns but the id.
+SYNC_JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dashboard_sync_jobs (
+    job_id serial PRIMARY KEY,
+    job json NOT NULL
+)
+"""
+
+SYNC_JOBS_LOCK = 7_402_116
+
+
+def ensure_sync_jobs(conn):
+    """Create the fleet sync job table."""
+    cur = conn.cursor()
+    # Workers starting together would race on CREATE ... IF NOT EXISTS
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (SYNC_JOBS_LOCK,))
+    cur.execute(SYNC_JOBS_SCHEMA)
+    cur.close()
+    conn.commit()
+
+
+def insert_sync_job(conn, job, keep):
+    """Store a new fleet sync job and return its id. Finished jobs older than
+    the newest keep jobs are deleted."""
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO dashboard_sync_jobs (job) VALUES (%s) RETURNING job_id",
+        (Json(job),),
+    )
+    job_id = cur.fetchone()[0]
+    cur.execute(
+        """
+        DELETE FROM dashboard_sync_jobs
+        WHERE job->>'status' = 'finished' AND job_id NOT IN (
+            SELECT job_id FROM dashboard_sync_jobs ORDER BY job_id DESC LIMIT %s
+        )
+        """,
+        (keep,),
+    )
+    cur.close()
+    return job_id
+
+
+def update_sync_job(conn, job_id, job):
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE dashboard_sync_jobs SET job = %s WHERE job_id = %s",
+        (Json(job), job_id),
+    )
+    cur.close()
+
+
+def fetch_sync_job(conn, job_id):
+    """Return the job stored under job_id, or None."""
+    cur = conn.cursor()
+    cur.execute("SELECT job FROM dashboard_sync_jobs WHERE job_id = %s", (job_id,))
+    row = cur.fetchone()
+    cur.close()
+    return None if row is None else row[0]
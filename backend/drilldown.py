@@ -0,0 +1,224 @@
+"""Raw pick and task rows, in pages or streamed whole.
+
+Rows come in (time, id, pick object) order, ascending or descending. A
+task is one row per object it picked, so the id alone does not tell its
+rows apart. A page ends with a cursor, the (time, id, pick object code) of
+its last row, and the next page holds the rows after it. Pages are read from the time-sorted segments of a table in
+windows that double in size until they hold enough matching rows, so a
+page costs about as much as the rows it returns, however deep into the
+table it is. Rows added behind a cursor after it was handed out are not
+seen by the pages that follow it.
+
+Rows are encoded as
+- application/json: {"rows": [{<column>: value, ...}, ...], "next_cursor":
+  cursor or null}, one page.
+- application/x-ndjson: one JSON object per line, every row.
+- text/csv: a header line and one line per row, every row.
+
+Times are ISO 8601 UTC, and dictionary codes are decoded to strings.
+"""
+
+import csv
+import io
+
+import numpy as np
+
+from formats import JSON, render_json
+from store import concatenate_columns
+
+
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+
+# Rows of the first window read from a segment, and the largest window
+FIRST_WINDOW = 4096
+MAX_WINDOW = 1 << 20
+
+# Orders the rows sharing a time and id
+TIEBREAK = "pick_object"
+
+
+def parse_cursor(cursor):
+    """Return the (time, id, tiebreak) of a cursor, or None if it is
+    malformed."""
+    parts = cursor.split(":")
+    if len(parts) != 3:
+        return None
+    time, row_id, tiebreak = parts
+    try:
+        return np.datetime64(int(time), "us"), int(row_id), int(tiebreak)
+    except (ValueError, OverflowError):
+        return None
+
+
+def format_cursor(time, row_id, tiebreak):
+    return f"{time.astype(np.int64)}:{row_id}:{tiebreak}"
+
+
+def segment_rows(table, lower, upper, equals, after, limit, descending):
+    """Positions of at least the first limit rows of a ColumnTable with
+    lower <= time <= upper that match equals and come after the (time, id,
+    tiebreak) cursor after, or of all of them if there are fewer."""
+    lo, hi = table.time_range(lower, upper)
+    times = table.columns[table.time_column]
+    ids = table.columns["id"]
+    tiebreaks = table.columns[TIEBREAK]
+    found = []
+    count = 0
+    window = max(limit, FIRST_WINDOW)
+    while lo < hi and count < limit:
+        if descending:
+            start, stop = max(lo, hi - window), hi
+            hi = start
+        else:
+            start, stop = lo, min(hi, lo + window)
+            lo = stop
+        window = min(window * 2, MAX_WINDOW)
+        if count + (stop - start) >= limit:
+            # Rows of the time the page may end at can be anywhere in the
+            # run of that time, and sort by id and tiebreak only once read
+            if descending:
+                start = np.searchsorted(times[lo:start], times[start]) + lo
+                hi = start
+            else:
+                stop = np.searchsorted(times[stop:hi], times[stop - 1], "right") + stop
+                lo = stop
+        rows = table.rows_in(start, stop, equals)
+        if isinstance(rows, slice):
+            rows = np.arange(rows.start, rows.stop)
+        if after is not None:
+            time, row_id, tiebreak = after
+            row_ids, row_tiebreaks = ids[rows], tiebreaks[rows]
+            if descending:
+                later = (row_ids < row_id) | (
+                    (row_ids == row_id) & (row_tiebreaks < tiebreak)
+                )
+            else:
+                later = (row_ids > row_id) | (
+                    (row_ids == row_id) & (row_tiebreaks > tiebreak)
+                )
+            rows = rows[(times[rows] != time) | later]
+        found.append(rows)
+        count += len(rows)
+    return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+
+def page(table, lower, upper, equals, after, limit, descending=False):
+    """The columns of the first limit rows of a SegmentedTable with lower <=
+    time <= upper that match equals and come after the cursor after, in
+    (time, id, tiebreak) order."""
+    if after is not None:
+        if descending:
+            upper = min(upper, after[0])
+        else:
+            lower = max(lower, after[0])
+    parts = []
+    for segment in (table.base, table.delta):
+        rows = segment_rows(segment, lower, upper, equals, after, limit, descending)
+        parts.append({name: column[rows] for name, column in segment.columns.items()})
+    columns = concatenate_columns(parts)
+    order = np.lexsort(
+        (columns[TIEBREAK], columns["id"], columns[table.base.time_column])
+    )
+    if descending:
+        order = order[::-1]
+    return {name: column[order[:limit]] for name, column in columns.items()}
+
+
+def decoded(table, columns):
+    """The columns as lists of values, in schema order, with NULLs as None."""
+    values = {}
+    for name, _, dictionary in table.base.schema:
+        column = columns[name]
+        if dictionary is not None:
+            values[name] = table.base.decode(name, column).tolist()
+        elif column.dtype.kind == "M":
+            values[name] = iso_times(column).tolist()
+        elif column.dtype.kind == "f":
+            # NULLs are stored as NaN
+            values[name] = [
+                None if value != value else value for value in column.tolist()
+            ]
+        else:
+            values[name] = column.tolist()
+    return values
+
+
+def iso_times(times):
+    return np.datetime_as_string(times, unit="us", timezone="UTC")
+
+
+def json_values(table, columns):
+    """The columns as lists of JSON texts, in schema order.
+
+    Encoding each row as a whole is several times slower for the scalar
+    values of these columns."""
+    values = {}
+    for name, _, dictionary in table.base.schema:
+        column = columns[name]
+        if dictionary is not None:
+            dictionary_values = table.base.encodings[name].values
+            encoded = [render_json(value).decode() for value in dictionary_values]
+            values[name] = [encoded[code] for code in column.tolist()]
+        elif column.dtype.kind == "M":
+            values[name] = [f'"{time}"' for time in iso_times(column).tolist()]
+        elif column.dtype.kind == "f":
+            values[name] = [
+                "null" if value != value else repr(value) for value in column.tolist()
+            ]
+        elif column.dtype.kind == "b":
+            values[name] = np.where(column, "true", "false").tolist()
+        else:
+            values[name] = list(map(str, column.tolist()))
+    return values
+
+
+def json_rows(table, columns):
+    """The rows of the columns as JSON objects, one text per row."""
+    values = json_values(table, columns)
+    template = ",".join(f"{render_json(name).decode()}:{{}}" for name in values)
+    return map(f"{{{{{template}}}}}".format, *values.values())
+
+
+def encode_rows(table, columns, media_type, header=True, next_cursor=None):
+    """Encode the columns of table rows as media_type. CSV starts with a
+    header line if header is true, JSON ends with next_cursor."""
+    if media_type == CSV:
+        values = decoded(table, columns)
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator="\n")
+        if header:
+            writer.writerow(values)
+        writer.writerows(zip(*values.values()))
+        return text.getvalue().encode("utf-8")
+    if media_type == NDJSON:
+        return "".join(row + "\n" for row in json_rows(table, columns)).encode("utf-8")
+    rows = ",".join(json_rows(table, columns))
+    cursor = render_json(next_cursor).decode()
+    return f'{{"rows":[{rows}],"next_cursor":{cursor}}}'.encode("utf-8")
+
+
+def page_body(
+    snapshot,
+    table,
+    lower,
+    upper,
+    equals,
+    after,
+    limit,
+    descending,
+    media_type=JSON,
+    header=True,
+):
+    """Return (the page encoded as media_type, its cursor or None if it is
+    the last page). Runs in the aggregation pool."""
+    rows = getattr(snapshot, table)
+    columns = page(rows, lower, upper, equals, after, limit, descending)
+    cursor = None
+    if len(columns["id"]) == limit:
+        cursor = format_cursor(
+            columns[rows.base.time_column][-1],
+            int(columns["id"][-1]),
+            int(columns[TIEBREAK][-1]),
+        )
+    return encode_rows(rows, columns, media_type, header, cursor), cursor
@@ -0,0 +1,100 @@
+"""Runs the CPU-heavy aggregation behind /picks and /tasks off the event loop."""
+
+import asyncio
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from metrics import collect, replay
+from snapshot import load_snapshot
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+# The snapshot a process pool worker has mapped, as (name, dataset)
+worker_snapshot = (None, None)
+
+
+def run_on_snapshot(directory, name, function, *args):
+    """Process pool entry point: return function(dataset, *args) for the
+    dataset of the named snapshot, mapping it on first use, together with
+    the spans it ran."""
+    global worker_snapshot
+    if worker_snapshot[0] != name:
+        dataset = load_snapshot(directory, name)
+        if dataset is None:
+            raise RuntimeError(f"Snapshot {name} is not available")
+        worker_snapshot = (name, dataset)
+    return collect(function, worker_snapshot[1], *args)
+
+
+class Aggregator:
+    """Runs function(dataset, *args) calls in a thread or process pool.
+
+    At most `workers` calls run at once and further ones wait for a slot, so
+    heavy queries never take over the event loop or the whole machine. A
+    call taking longer than `timeout` seconds, waiting included, raises
+    QueryTimeout. Cancelling a call that is still waiting frees its place; a
+    call already running in a worker cannot be interrupted and keeps its
+    slot until it finishes.
+
+    Process pool workers cannot share the parent's dataset, so they map the
+    published snapshot of it from snapshot_dir. Calls for a dataset that has
+    no snapshot yet run in a thread instead."""
+
+    def __init__(self, kind, workers, timeout, snapshot_dir=None):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown aggregation executor {kind!r}")
+        self.timeout = timeout
+        self.snapshot_dir = snapshot_dir
+        self.slots = asyncio.Semaphore(workers)
+        self.threads = ThreadPoolExecutor(workers, thread_name_prefix="aggregate")
+        self.processes = None
+        if kind == "process":
+            # Forking a process running an event loop and thread pools is not
+            # safe, start clean interpreters instead
+            self.processes = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn")
+            )
+
+    async def run(self, snapshot_name, function, dataset, *args):
+        try:
+            return await asyncio.wait_for(
+                self.submit(snapshot_name, function, dataset, *args),
+                self.timeout or None,
+            )
+        except asyncio.TimeoutError:
+            raise QueryTimeout(f"Query did not finish within {self.timeout}s") from None
+
+    async def submit(self, snapshot_name, function, dataset, *args):
+        await self.slots.acquire()
+        in_process = self.processes is not None and snapshot_name is not None
+        try:
+            if in_process:
+                future = self.processes.submit(
+                    run_on_snapshot, self.snapshot_dir, snapshot_name, function, *args
+                )
+            else:
+                # Spans in the thread belong to the request that submitted it
+                context = contextvars.copy_context()
+                future = self.threads.submit(context.run, function, dataset, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self.slots.release)
+        )
+        # Cancelling the wrapper cancels the call if it has not started
+        result = await asyncio.wrap_future(future)
+        if in_process:
+            result, spans = result
+            replay(spans)
+        return result
+
+    def close(self):
+        self.threads.shutdown(wait=False, cancel_futures=True)
+        if self.processes is not None:
+            self.processes.shutdown(wait=False, cancel_futures=True)
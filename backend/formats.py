@@ -0,0 +1,129 @@
+"""Encodings of the /picks and /tasks responses, chosen by the Accept header.
+
+- application/json (the default): {"series": [{"date": ..., <field>: ...},
+  ...], "min_<field>": ..., "max_<field>": ...}.
+- application/vnd.dashboard.columnar+json: the same, with the series as
+  one array per field: {"series": {"date": [...], <field>: [...]}, ...}.
+- application/vnd.dashboard.packed: the series as packed little-endian
+  arrays, laid out as
+
+      b"DSHB" | version (uint32) | header length (uint32) | header | columns
+
+  The header is UTF-8 JSON: {"rows": n, "columns": [{"name", "dtype",
+  "offset", "length"}], "envelope": {"min_<field>": ..., ...}}. Offsets and
+  lengths are in bytes from the start of the columns, which like every
+  column starts on an 8-byte boundary. dtype is "<i4" (Int32Array) or
+  "<f8" (Float64Array). Dates are the start of each period in milliseconds
+  since the epoch.
+
+Grouped responses, {"groups": [{<dimension>: value, "series": ...,
+"min_<field>": ..., ...}, ...]}, come in the two JSON shapes only.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+
+JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.dashboard.columnar+json"
+PACKED = "application/vnd.dashboard.packed"
+
+PACKED_MAGIC = b"DSHB"
+PACKED_VERSION = 1
+
+INT32 = np.iinfo(np.int32)
+
+
+def negotiate(accept, offered=(JSON, COLUMNAR_JSON, PACKED)):
+    """Return the offered media type the Accept header prefers, falling back
+    to JSON for anything else, wildcards included."""
+    best, best_quality = JSON, 0.0
+    for media_range in (accept or "").split(","):
+        media_type, *parameters = media_range.split(";")
+        media_type = media_type.strip().lower()
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type in offered and quality > best_quality:
+            best, best_quality = media_type, quality
+    return best
+
+
+def render_json(content):
+    # Same encoding as FastAPI's JSONResponse
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def row_series(response):
+    """The response with its series as one object per period."""
+    columns = response["series"]
+    names = list(columns)
+    series = [dict(zip(names, values)) for values in zip(*columns.values())]
+    return {**response, "series": series}
+
+
+def packed_column(name, values):
+    if name == "date":
+        return np.array(values, dtype="datetime64[ms]").astype("<f8")
+    array = np.asarray(values)
+    if array.dtype.kind in "iub" and (
+        not len(array) or (array.min() >= INT32.min and array.max() <= INT32.max)
+    ):
+        return array.astype("<i4")
+    return array.astype("<f8")
+
+
+def pad(length):
+    return -length % 8
+
+
+def packed(response):
+    columns = []
+    specs = []
+    offset = 0
+    for name, values in response["series"].items():
+        array = packed_column(name, values)
+        specs.append(
+            {
+                "name": name,
+                "dtype": array.dtype.str,
+                "offset": offset,
+                "length": array.nbytes,
+            }
+        )
+        columns.append(array.tobytes() + bytes(pad(array.nbytes)))
+        offset += array.nbytes + pad(array.nbytes)
+
+    header = render_json(
+        {
+            "rows": len(response["series"]["date"]),
+            "columns": specs,
+            "envelope": {
+                name: value for name, value in response.items() if name != "series"
+            },
+        }
+    )
+    # The columns start on an 8-byte boundary of the whole body
+    header += b" " * pad(12 + len(header))
+    prefix = PACKED_MAGIC + struct.pack("<II", PACKED_VERSION, len(header))
+    return b"".join([prefix, header, *columns])
+
+
+def encode(response, media_type):
+    if media_type == PACKED:
+        return packed(response)
+    if media_type == COLUMNAR_JSON:
+        return render_json(response)
+    if "groups" in response:
+        groups = [row_series(group) for group in response["groups"]]
+        return render_json({"groups": groups})
+    return render_json(row_series(response))
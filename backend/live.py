@@ -0,0 +1,289 @@
+"""Live /picks and /tasks series, pushed to subscribers as server-sent events.
+
+A live series covers the periods from a lower bound up to the newest row,
+for one filter set, interval and calendar. Subscriptions to the same series
+share one Feed, which computes it once per dataset generation and fans the
+result out to every subscriber as events:
+
+- `series`: the whole response, in the row JSON shape of /picks and
+  /tasks. Sent first, and again to a subscriber that fell too far behind
+  to be sent every change.
+- `delta`: {"from": date, "series": [...], "min_<field>": ..., ...}. The
+  periods from date on replace the subscriber's, and the envelope replaces
+  its envelope. Refreshes mostly add rows to the last periods, so a delta
+  is usually one or two periods long.
+- `error`: {"detail": ...}, after which the stream ends. EventSource
+  clients reconnect by themselves.
+
+When a generation directly follows the one a feed last computed, only the
+periods from the one holding the earliest changed row (see
+Dataset.changed_from) are aggregated again.
+"""
+
+import asyncio
+import logging
+
+import numpy as np
+
+from aggregate import generate_intervals, merge_period_sums, quantile_sums
+from executor import QueryTimeout
+from formats import render_json, row_series
+from rollup import period_sums
+from sketch import Sketches
+from zones import OffsetTable
+
+
+logger = logging.getLogger("uvicorn.error")
+
+# Sent when there is nothing else to send, so proxies keep the stream open
+HEARTBEAT = b": heartbeat\n\n"
+
+
+def live_sums(
+    snapshot,
+    table,
+    summarize,
+    lower,
+    interval,
+    equals,
+    tz,
+    quantiles,
+    changed_from=None,
+):
+    """Sums per period of the rows of table from lower to the newest one.
+
+    With changed_from, only the periods from the one holding that time are
+    aggregated. Returns (first period aggregated or None for all, periods,
+    sums)."""
+    rows = getattr(snapshot, table)
+    upper = rows.last_time()
+    if np.isnat(upper) or upper < lower:
+        upper = lower
+    zone = None if tz is None else OffsetTable.spanning(tz, lower, upper)
+    if zone is not None and zone.is_utc:
+        zone = None
+
+    cut = None
+    if changed_from is not None:
+        cut = generate_intervals(interval, np.array([changed_from]), zone)[0][0]
+        start = cut.astype("datetime64[us]")
+        if zone is not None:
+            # The UTC instant a local period starts at is at most the largest
+            # offset earlier than its wall-clock time
+            start -= max(zone.offsets.max(), np.timedelta64(0, "us"))
+        lower = max(lower, start)
+
+    periods, sums = period_sums(
+        rows,
+        getattr(snapshot, f"{table}_rollup"),
+        summarize(snapshot.dictionaries, sketches=quantiles),
+        lower,
+        upper,
+        interval,
+        equals,
+        zone=zone,
+        sketches=quantiles,
+    )
+    if cut is not None:
+        periods, sums = kept_periods(periods, sums, periods >= cut)
+    return cut, periods, sums
+
+
+def kept_periods(periods, sums, keep):
+    """The periods and sums of the periods where keep is true."""
+    kept = {}
+    for name, values in sums.items():
+        if isinstance(values, Sketches):
+            segment_of = np.where(keep, np.cumsum(keep) - 1, -1)
+            kept[name] = values.regroup(segment_of, int(keep.sum()))
+        else:
+            kept[name] = values[..., keep]
+    return periods[keep], kept
+
+
+def series_delta(previous, response):
+    """The delta turning the row response previous into response, or None if
+    they are the same."""
+    old, new = previous["series"], response["series"]
+    first = 0
+    while first < min(len(old), len(new)) and old[first] == new[first]:
+        first += 1
+    if first == len(old) == len(new):
+        # The envelope follows from the series
+        return None
+    # Past the end of new when only periods at the end went away
+    date = new[first]["date"] if first < len(new) else old[first]["date"]
+    envelope = {name: value for name, value in response.items() if name != "series"}
+    return {"from": date, "series": new[first:], **envelope}
+
+
+def event(name, data):
+    # render_json output has no newlines, so it fits on one data line
+    return b"event: " + name.encode() + b"\ndata: " + render_json(data) + b"\n\n"
+
+
+class Feed:
+    """One live series and the queues of the subscribers following it."""
+
+    def __init__(
+        self,
+        hub,
+        key,
+        table,
+        summarize,
+        respond,
+        lower,
+        interval,
+        equals,
+        tz,
+        quantiles,
+    ):
+        self.hub = hub
+        self.key = key
+        self.table = table
+        self.summarize = summarize
+        self.respond = respond
+        self.lower = lower
+        self.interval = interval
+        self.equals = equals
+        self.tz = tz
+        self.quantiles = quantiles
+        self.subscribers = set()
+        # Generation, periods and sums the response was computed from
+        self.generation = None
+        self.periods = None
+        self.sums = None
+        self.response = None
+        self.series_event = None
+        self.wake = asyncio.Event()
+        self.wake.set()
+        self.task = asyncio.create_task(self.follow())
+
+    async def follow(self):
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            snapshot = self.hub.dataset
+            if snapshot.generation == self.generation:
+                continue
+            try:
+                await self.update(snapshot)
+            except Exception as e:
+                if isinstance(e, QueryTimeout):
+                    detail = str(e)
+                else:
+                    logger.exception("Failed to update live %s series", self.table)
+                    detail = "Failed to compute the live series."
+                self.end(event("error", {"detail": detail}))
+                return
+
+    async def update(self, snapshot):
+        changed_from = None
+        if (
+            self.response is not None
+            and snapshot.generation == self.generation + 1
+            and snapshot.changed_from is not None
+        ):
+            changed_from = snapshot.changed_from[self.table]
+            if changed_from is None:
+                # No rows of this table changed
+                self.generation = snapshot.generation
+                return
+
+        cut, periods, sums = await self.hub.run(
+            snapshot,
+            live_sums,
+            self.table,
+            self.summarize,
+            self.lower,
+            self.interval,
+            self.equals,
+            self.tz,
+            self.quantiles,
+            changed_from,
+        )
+        if cut is not None:
+            head = kept_periods(self.periods, self.sums, self.periods < cut)
+            periods, sums = merge_period_sums([head, (periods, sums)])
+        response = row_series(self.respond(periods, quantile_sums(sums)))
+
+        previous = self.response
+        self.generation = snapshot.generation
+        self.periods, self.sums, self.response = periods, sums, response
+        self.series_event = event("series", response)
+        if previous is None:
+            self.send(self.series_event)
+            return
+        delta = series_delta(previous, response)
+        if delta is not None:
+            self.send(event("delta", delta))
+
+    def send(self, data):
+        for queue in self.subscribers:
+            if queue.qsize() >= self.hub.queue_size:
+                # Too far behind for deltas, start it over from the series
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.series_event)
+            else:
+                queue.put_nowait(data)
+
+    def end(self, data=None):
+        """Send data, if any, to every subscriber and end their streams."""
+        if self.hub.feeds.get(self.key) is self:
+            del self.hub.feeds[self.key]
+        self.task.cancel()
+        for queue in self.subscribers:
+            if data is not None:
+                queue.put_nowait(data)
+            queue.put_nowait(None)
+
+
+class LiveHub:
+    """The feeds of every live series subscribed to in this worker.
+
+    run(snapshot, function, *args) must run function(snapshot, *args) off
+    the event loop, and `publish` must be called with every new dataset."""
+
+    def __init__(self, run, heartbeat, queue_size):
+        self.run = run
+        self.heartbeat = heartbeat
+        # Events a subscriber can fall behind by
+        self.queue_size = queue_size
+        self.feeds = {}
+        self.dataset = None
+
+    def publish(self, dataset):
+        self.dataset = dataset
+        for feed in self.feeds.values():
+            feed.wake.set()
+
+    async def subscribe(self, key, *series):
+        """Yield the events of the live series (table, summarize, respond,
+        lower, interval, equals, tz, quantiles), sharing one Feed with every
+        other subscription of the same key."""
+        feed = self.feeds.get(key)
+        if feed is None:
+            feed = self.feeds[key] = Feed(self, key, *series)
+        queue = asyncio.Queue()
+        if feed.series_event is not None:
+            queue.put_nowait(feed.series_event)
+        feed.subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+                    continue
+                if data is None:
+                    return
+                yield data
+        finally:
+            feed.subscribers.discard(queue)
+            if not feed.subscribers:
+                feed.end()
+
+    def close(self):
+        for feed in list(self.feeds.values()):
+            feed.end()
@@ -1,13 +1,44 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+import asyncio
+import logging
 import numpy as np
-import psycopg2
 import os
+import time
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+import hashlib
 import httpx
-import requests
+
+from aggregate import (
+    grouped_response,
+    picks_response,
+    quantile_sums,
+    tasks_response,
+)
+from cache import ResponseCache
+from db import (
+    ConnectionPool,
+    RobotLocks,
+    ensure_sync_jobs,
+    ensure_task_aggregate_indexes,
+    ensure_task_aggregates,
+    fetch_last_syncs,
+    load_dataset,
+    refresh_dataset,
+)
+from drilldown import CSV, NDJSON, page_body, parse_cursor
+from executor import Aggregator, QueryTimeout
+from formats import COLUMNAR_JSON, JSON, encode, negotiate, render_json
+from live import LiveHub
+from metrics import TimingMiddleware, render as render_metrics, span
+from rollup import period_sums, summarize_picks, summarize_tasks
+from snapshot import LeaderLock, current_snapshot, load_snapshot, save_snapshot
+from sync import SyncScheduler, describe_error
+from zones import OffsetTable, time_zone
 
 
 # Load environment variables from .env file
@@ -20,131 +51,245 @@ PGPORT = os.getenv("PGPORT")
 PGDATABASE = os.getenv("PGDATABASE")
 PGPASSWORD = os.getenv("PGPASSWORD")
 
-# Global variables to store the pre-loaded data
-picks_data = None
-tasks_data = None
-robots_data = None
-sites_data = None
-objects_data = None
+# Size of the Postgres connection pool shared by all endpoints
+PGPOOL_MIN = int(os.getenv("PGPOOL_MIN", "1"))
+PGPOOL_MAX = int(os.getenv("PGPOOL_MAX", "10"))
+
+# Robots synced at the same time, and where their backups are restored
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "8"))
+RESTORE_URL = os.getenv("RESTORE_URL", "http://192.168.195.194:8000/api/restore_data")
+# Backups are streamed to the restore server in chunks of SYNC_CHUNK_SIZE
+# bytes, holding at most SYNC_MAX_IN_FLIGHT bytes per robot in memory, half
+# for the window being restored and half for the next one
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", str(1024 * 1024)))
+SYNC_MAX_IN_FLIGHT = int(os.getenv("SYNC_MAX_IN_FLIGHT", str(8 * 1024 * 1024)))
+# Robots are synced in windows of at most SYNC_WINDOW seconds of recorded
+# data, each logged in sync_log once restored so an interrupted sync resumes
+# from there
+SYNC_WINDOW = float(os.getenv("SYNC_WINDOW", str(24 * 3600)))
+
+# Memory budget in bytes and lifetime in seconds of cached /picks and /tasks
+# responses
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+
+# Seconds between polls for new picks and tasks, 0 disables the refresh
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", "60"))
+
+# Directory of the on-disk dataset snapshot used for fast restarts ("" to
+# disable), and the minimum number of seconds between snapshot writes
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshot")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "600"))
+
+# "local": every worker process loads and refreshes its own dataset.
+# "shared": for uvicorn --workers N; one worker loads and refreshes the
+# dataset and publishes every refresh as a snapshot under SNAPSHOT_DIR, and
+# the other workers memory-map those snapshots read-only, checking for a new
+# one every SHARED_POLL_INTERVAL seconds.
+DATASET_MODE = os.getenv("DATASET_MODE", "local")
+SHARED_POLL_INTERVAL = float(os.getenv("SHARED_POLL_INTERVAL", "1"))
+
+# /picks and /tasks are aggregated in a "thread" or "process" pool of
+# AGGREGATION_WORKERS workers, which is also the number of such queries
+# running at once. Queries are given AGGREGATION_TIMEOUT seconds (0 for no
+# limit). Process workers map the published snapshots, so "process" needs a
+# SNAPSHOT_DIR.
+AGGREGATION_EXECUTOR = os.getenv("AGGREGATION_EXECUTOR", "thread")
+AGGREGATION_WORKERS = int(os.getenv("AGGREGATION_WORKERS", str(os.cpu_count() or 1)))
+AGGREGATION_TIMEOUT = float(os.getenv("AGGREGATION_TIMEOUT", "30"))
+
+# Live series streams send a heartbeat after LIVE_HEARTBEAT idle seconds, and
+# a subscriber more than LIVE_QUEUE_SIZE events behind is sent the whole
+# series again instead
+LIVE_HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", "15"))
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "16"))
+
+# Rows per page of /picks/rows and /tasks/rows by default and at most, and
+# per page read while streaming them as NDJSON or CSV
+ROWS_PAGE_SIZE = int(os.getenv("ROWS_PAGE_SIZE", "1000"))
+ROWS_MAX_PAGE_SIZE = int(os.getenv("ROWS_MAX_PAGE_SIZE", "10000"))
+ROWS_EXPORT_PAGE_SIZE = int(os.getenv("ROWS_EXPORT_PAGE_SIZE", "50000"))
+
+# Report the stages of each request in a Server-Timing response header
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+logger = logging.getLogger("uvicorn.error")
+
+# Global variables to store the pre-loaded data. dataset is only ever
+# replaced as a whole, so read it once per request.
+dataset = None
 destinations_data = None
+pool = None
+sync_scheduler = None
+aggregator = None
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL)
+# The dataset last written to the snapshot and when
+snapshot_dataset = None
+snapshot_time = 0.0
+# Generation and name of the newest snapshot written or attached to
+published_snapshot = (None, None)
+# Shared mode: the lock held by the loading worker, and the name of the
+# snapshot a follower is attached to
+leader_lock = None
+attached_snapshot = None
+# The dataset the /robots, /sites and /objects bodies were rendered from,
+# and those bodies by the function building their content
+metadata_bodies = (None, {})
+
+
+def with_connection(function, *args):
+    """Run function(conn, *args) on a pooled connection."""
+    with pool.connection() as conn:
+        return function(conn, *args)
+
+
+async def run_query(function, *args):
+    """Run a blocking database function on a pooled connection in a worker
+    thread, so the event loop keeps serving other requests."""
+    return await asyncio.to_thread(with_connection, function, *args)
+
+
+async def run_aggregation(snapshot, function, *args):
+    return await aggregator.run(snapshot_name(snapshot), function, snapshot, *args)
+
+
+live_hub = LiveHub(run_aggregation, LIVE_HEARTBEAT, LIVE_QUEUE_SIZE)
+
+
+def refresh():
+    with span("dataset.refresh"):
+        return with_connection(refresh_dataset, dataset)
+
+
+def load_or_catch_up():
+    """Load the current snapshot and the picks and tasks added since it was
+    taken, or the full history if there is no snapshot."""
+    global snapshot_dataset, published_snapshot
+    name = current_snapshot(SNAPSHOT_DIR) if SNAPSHOT_DIR else None
+    with span("dataset.snapshot"):
+        snapshot = load_snapshot(SNAPSHOT_DIR, name) if name else None
+    if snapshot is None:
+        with span("dataset.load"):
+            return with_connection(load_dataset)
+    snapshot_dataset = snapshot
+    published_snapshot = (snapshot.generation, name)
+    with span("dataset.refresh"):
+        return with_connection(refresh_dataset, snapshot)
+
+
+def is_leader():
+    """Whether this worker loads and refreshes the dataset itself."""
+    return DATASET_MODE != "shared" or leader_lock.acquire()
+
+
+def snapshot_name(snapshot):
+    """Name of the published snapshot holding snapshot, or None."""
+    generation, name = published_snapshot
+    return name if generation == snapshot.generation else None
+
+
+async def save_snapshot_if_due():
+    global snapshot_dataset, snapshot_time, published_snapshot
+    snapshot = dataset
+    if not SNAPSHOT_DIR or snapshot is snapshot_dataset:
+        return
+    # Shared-mode followers and process pool workers need every refresh
+    if DATASET_MODE == "shared" or AGGREGATION_EXECUTOR == "process":
+        interval = 0
+    else:
+        interval = SNAPSHOT_INTERVAL
+    if snapshot_dataset and time.monotonic() - snapshot_time < interval:
+        return
+    try:
+        path = await asyncio.to_thread(save_snapshot, snapshot, SNAPSHOT_DIR)
+        snapshot_dataset, snapshot_time = snapshot, time.monotonic()
+        published_snapshot = (snapshot.generation, os.path.basename(path))
+    except Exception:
+        logger.exception("Failed to write the dataset snapshot")
+
+
+async def first_dataset():
+    global attached_snapshot, published_snapshot
+    while not is_leader():
+        # Wait for the leader to publish a snapshot
+        name = current_snapshot(SNAPSHOT_DIR)
+        snapshot = name and await asyncio.to_thread(load_snapshot, SNAPSHOT_DIR, name)
+        if snapshot:
+            attached_snapshot = name
+            published_snapshot = (snapshot.generation, name)
+            return snapshot
+        await asyncio.sleep(SHARED_POLL_INTERVAL)
+    return await asyncio.to_thread(load_or_catch_up)
+
+
+async def maintain_dataset():
+    global dataset, attached_snapshot, published_snapshot
+    if not is_leader():
+        # Attach to every snapshot the leader publishes, until the leader
+        # goes away and this worker takes over
+        while not is_leader():
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            name = current_snapshot(SNAPSHOT_DIR)
+            if name == attached_snapshot:
+                continue
+            snapshot = await asyncio.to_thread(load_snapshot, SNAPSHOT_DIR, name)
+            if snapshot is not None:
+                dataset, attached_snapshot = snapshot, name
+                published_snapshot = (snapshot.generation, name)
+                live_hub.publish(dataset)
+        dataset = await asyncio.to_thread(load_or_catch_up)
+        live_hub.publish(dataset)
+
+    await save_snapshot_if_due()
+    while REFRESH_INTERVAL > 0:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            # Fetch and merge off the event loop, then swap in one assignment
+            dataset = await asyncio.to_thread(refresh)
+            live_hub.publish(dataset)
+        except Exception:
+            logger.exception("Failed to refresh picks and tasks")
+        await save_snapshot_if_due()
+
+
+async def build_task_aggregate_indexes():
+    # Off the start-up path: on a long history the first build takes a while,
+    # and the task aggregates are only slower to refresh without the indexes
+    try:
+        await run_query(ensure_task_aggregate_indexes)
+    except Exception:
+        logger.exception("Failed to create the task aggregate indexes")
 
 
-# Instantiate the FastAPI app with picks_data and tasks_data from postgres db
+# Instantiate the FastAPI app with picks and tasks from postgres db
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global picks_data, tasks_data, robots_data, sites_data, objects_data, destinations_data
+    global dataset, destinations_data, pool, sync_scheduler, leader_lock, aggregator
 
     # Connect to the database
-    conn = psycopg2.connect(
-        dbname=PGDATABASE, user=PGUSER, password=PGPASSWORD, host=PGHOST, port=PGPORT
-    )
-
-    # Create a cursor object
-    cur = conn.cursor()
-
-    # Fetch picks data with robot_id
-    cur.execute(
-        """
-SELECT 
-    p.start_pick_time AT TIME ZONE 'UTC' as start_pick_time_utc, 
-    p.pick_object,
-    EXTRACT(EPOCH FROM (p.end_pick_time - p.start_pick_time)) as duration,
-    e.robot_id,
-    3600 / EXTRACT(EPOCH FROM (p.end_pick_time - p.start_pick_time)) as pph,
-    e.description
-FROM execution_data_pick p
-JOIN execution_data_task t ON p.task_id = t.id
-JOIN execution_data_run r ON t.run_id = r.id
-JOIN execution_data_experiment e ON r.experiment_id = e.id
-WHERE EXTRACT(EPOCH FROM (p.end_pick_time - p.start_pick_time)) > 0
-AND extract(EPOCH from (p.end_pick_time - p.start_pick_time)) <= 5
-AND extract(EPOCH from (p.end_pick_time - p.start_pick_time)) > 1
-AND p.failure_state = 'succeeded';
-    """
-    )
-    picks_data = np.array(cur.fetchall())
-
-    # Fetch tasks data with robot_id
-    cur.execute(
-        """
-   SELECT 
-    first_pick.pick_object,
-    t.success, 
-    EXTRACT(EPOCH FROM (t.end_date - t.start_date)) as duration, 
-    EXTRACT(EPOCH FROM sp.successful_picks_duration) AS successful_picks_duration,
-    COALESCE(sp.successful_pick_count, 0) AS successful_pick_count,
-    COALESCE(up.unsuccessful_pick_count, 0) AS unsuccessful_pick_count,
-    t.start_date AT TIME ZONE 'UTC' as start_date_utc, 
-    t.id, 
-    e.robot_id, 
-    e.description
-FROM 
-    execution_data_task t
-JOIN 
-    execution_data_run r ON t.run_id = r.id
-JOIN 
-    execution_data_experiment e ON r.experiment_id = e.id
-LEFT JOIN 
-    (SELECT 
-        task_id, 
-        pick_object 
-     FROM 
-        execution_data_pick 
-     WHERE 
-        pick_object IS NOT NULL 
-     GROUP BY task_id, pick_object 
-    ) AS first_pick ON t.id = first_pick.task_id
-LEFT JOIN 
-    (SELECT 
-        task_id, 
-        COUNT(*) AS successful_pick_count,
-        SUM(end_pick_time - start_pick_time) AS successful_picks_duration
-     FROM 
-        execution_data_pick 
-     WHERE 
-        failure_state = 'succeeded'
-        AND end_pick_time IS NOT NULL
-     GROUP BY 
-        task_id
-    ) AS sp ON t.id = sp.task_id
-LEFT JOIN 
-    (SELECT 
-        task_id, 
-        COUNT(*) AS unsuccessful_pick_count 
-     FROM 
-        execution_data_pick 
-     WHERE 
-        failure_state <> 'succeeded'
-     GROUP BY 
-        task_id
-    ) AS up ON t.id = up.task_id
-GROUP BY 
-    t.id, e.robot_id, first_pick.pick_object, e.description, sp.successful_pick_count, up.unsuccessful_pick_count, sp.successful_picks_duration;
-    """
-    )
-    tasks_data = np.array(cur.fetchall())
-
-    # Fetch robots
-    cur.execute(
-        """
-        SELECT * FROM execution_data_robot;
-        """
-    )
-    robots_data = np.array(cur.fetchall())
-
-    cur.execute(
-        """
-        SELECT DISTINCT description FROM execution_data_experiment;
-        """
+    database = dict(
+        dbname=PGDATABASE,
+        user=PGUSER,
+        password=PGPASSWORD,
+        host=PGHOST,
+        port=PGPORT,
     )
-    sites_data = np.array(cur.fetchall())
-
-    cur.execute(
-        """
-        SELECT DISTINCT pick_object FROM execution_data_pick; 
-        """
+    pool = ConnectionPool(PGPOOL_MIN, PGPOOL_MAX, **database)
+    with_connection(ensure_task_aggregates)
+    with_connection(ensure_sync_jobs)
+    indexer = asyncio.create_task(build_task_aggregate_indexes())
+    if DATASET_MODE == "shared":
+        if not SNAPSHOT_DIR:
+            raise RuntimeError("DATASET_MODE=shared requires a SNAPSHOT_DIR")
+        leader_lock = LeaderLock(SNAPSHOT_DIR)
+    if AGGREGATION_EXECUTOR == "process" and not SNAPSHOT_DIR:
+        raise RuntimeError("AGGREGATION_EXECUTOR=process requires a SNAPSHOT_DIR")
+    aggregator = Aggregator(
+        AGGREGATION_EXECUTOR, AGGREGATION_WORKERS, AGGREGATION_TIMEOUT, SNAPSHOT_DIR
     )
-    objects_data = np.array(cur.fetchall())
+    dataset = await first_dataset()
+    live_hub.publish(dataset)
+    maintainer = asyncio.create_task(maintain_dataset())
 
     destinations_data = np.array(
         [
@@ -168,10 +313,28 @@ GROUP BY
             },
         ]
     )
+
+    client = httpx.AsyncClient()
+    robot_locks = RobotLocks(**database)
+    sync_scheduler = SyncScheduler(
+        client,
+        run_query,
+        robot_locks,
+        RESTORE_URL,
+        SYNC_CONCURRENCY,
+        SYNC_CHUNK_SIZE,
+        SYNC_MAX_IN_FLIGHT,
+        timedelta(seconds=SYNC_WINDOW),
+    )
+
     yield
-    # Close the cursor and connection
-    cur.close()
-    conn.close()
+    indexer.cancel()
+    maintainer.cancel()
+    live_hub.close()
+    aggregator.close()
+    await client.aclose()
+    robot_locks.close()
+    pool.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -184,489 +347,853 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(TimingMiddleware, server_timing=SERVER_TIMING)
 
 
-def filter_picks_data(lowerbound_dt, upperbound_dt, robot_id, site, pick_object):
-    # Timezone conversion
-    lowerbound_dt_utc = np.datetime64(lowerbound_dt.astimezone(timezone.utc))
-    upperbound_dt_utc = np.datetime64(upperbound_dt.astimezone(timezone.utc))
+def to_utc_datetime64(dt):
+    # Timezone conversion to the naive UTC timestamps stored in the columns
+    return np.datetime64(dt.astimezone(timezone.utc).replace(tzinfo=None), "us")
 
-    # Data filtering
-    filtered_data = picks_data[
-        (picks_data[:, 0] >= lowerbound_dt_utc)
-        & (picks_data[:, 0] <= upperbound_dt_utc)
-    ]
-    if robot_id != "all":
-        filtered_data = filtered_data[filtered_data[:, 3] == robot_id]
-    if site != "all":
-        filtered_data = filtered_data[filtered_data[:, 5] == site]
-    if pick_object != "all":
-        filtered_data = filtered_data[filtered_data[:, 1] == pick_object]
 
-    return filtered_data
+# Dimensions the series can be filtered and grouped by
+DIMENSIONS = ("robot_id", "site", "pick_object")
 
 
-def filter_tasks_data(lowerbound_dt, upperbound_dt, robot_id, site, pick_object):
-    # Timezone conversion
-    lowerbound_dt_utc = np.datetime64(lowerbound_dt.astimezone(timezone.utc))
-    upperbound_dt_utc = np.datetime64(upperbound_dt.astimezone(timezone.utc))
+def equality_filters(robot_id, site, pick_object):
+    # Each dimension is a list of values to match any of, "all" matches
+    # everything
+    filters = {"robot_id": robot_id, "site": site, "pick_object": pick_object}
+    return {name: values for name, values in filters.items() if "all" not in values}
 
-    # Data filtering
-    filtered_data = tasks_data[
-        (tasks_data[:, 6] >= lowerbound_dt_utc)
-        & (tasks_data[:, 6] <= upperbound_dt_utc)
-    ]
-    if robot_id != "all":
-        filtered_data = filtered_data[filtered_data[:, 8] == robot_id]
-    if site != "all":
-        filtered_data = filtered_data[filtered_data[:, 9] == site]
-    if pick_object != "all":
-        filtered_data = filtered_data[filtered_data[:, 0] == pick_object]
 
-    return filtered_data
+def grouping(table, group_by, equals):
+    """Return the groups of a query grouped by the group_by dimension, as
+    ((group_by, group of each code, number of groups), group values).
 
+    The groups are the values the dimension is filtered to, in order, or
+    every value of its dictionary when it is not filtered."""
+    dictionary = table.base.encodings[group_by]
+    values = equals.get(group_by)
+    if values is None:
+        values = list(dictionary.values)
+        group_of_code = np.arange(len(values))
+    else:
+        group_of_code = np.full(len(dictionary), -1)
+        for group, value in enumerate(values):
+            code = dictionary.lookup(value)
+            if code >= 0:
+                group_of_code[code] = group
+    return (group_by, group_of_code, len(values)), values
 
-def generate_intervals(interval, filtered_data):
-    intervals = {"daily": "D", "weekly": "W", "monthly": "M"}
-    date_interval = intervals[interval]
-    dates = np.array(
-        [
-            np.datetime64(dt).astype(f"datetime64[{date_interval}]")
-            for dt in filtered_data[:, 0]
-        ]
+
+def filter_picks_data(
+    snapshot, lowerbound_dt, upperbound_dt, robot_id, site, pick_object
+):
+    return snapshot.picks.select(
+        to_utc_datetime64(lowerbound_dt),
+        to_utc_datetime64(upperbound_dt),
+        equality_filters(robot_id, site, pick_object),
     )
-    unique_intervals = np.unique(dates)
 
-    return dates, unique_intervals
 
+def filter_tasks_data(
+    snapshot, lowerbound_dt, upperbound_dt, robot_id, site, pick_object
+):
+    return snapshot.tasks.select(
+        to_utc_datetime64(lowerbound_dt),
+        to_utc_datetime64(upperbound_dt),
+        equality_filters(robot_id, site, pick_object),
+    )
 
-@app.get("/picks")
-async def read_mpph(
-    lowerbound_dt: datetime,
-    upperbound_dt: datetime,
-    interval: str,
-    robot_id: str = "all",
-    site: str = "all",
-    pick_object: str = "all",
+
+def compute_series(
+    table,
+    rollup,
+    summarize,
+    respond,
+    lowerbound_dt,
+    upperbound_dt,
+    interval,
+    robot_id,
+    site,
+    pick_object,
+    group_by,
+    tz,
+    quantiles,
 ):
-    # Validate interval input
+    lower = to_utc_datetime64(lowerbound_dt)
+    upper = to_utc_datetime64(upperbound_dt)
+    equals = equality_filters(robot_id, site, pick_object)
+    group = None
+    if group_by is not None:
+        group, values = grouping(table, group_by, equals)
+    zone = None if tz is None else OffsetTable.spanning(tz, lower, upper)
+    if zone is not None and zone.is_utc:
+        # Same calendar as the default, and the same sums
+        zone = None
+    unique_intervals, sums = period_sums(
+        table,
+        rollup,
+        summarize(table.dictionaries, sketches=quantiles),
+        lower,
+        upper,
+        interval,
+        equals,
+        group,
+        zone,
+        sketches=quantiles,
+    )
+    with span("response"):
+        if quantiles:
+            sums = quantile_sums(sums)
+        if group is None:
+            return respond(unique_intervals, sums)
+        if group_by not in equals:
+            # Of an unfiltered dimension, only the values that have rows
+            present = np.flatnonzero(sums["rows"].any(axis=1))
+            values = [values[i] for i in present]
+            sums = {name: group_sums[present] for name, group_sums in sums.items()}
+        return grouped_response(group_by, values, unique_intervals, sums, respond)
+
+
+def compute_picks(
+    snapshot,
+    lowerbound_dt,
+    upperbound_dt,
+    interval,
+    robot_id,
+    site,
+    pick_object,
+    group_by=None,
+    tz=None,
+    quantiles=False,
+):
+    # MPPH, durations, picks and tonnes per interval, with whole days taken
+    # from the daily rollup
+    return compute_series(
+        snapshot.picks,
+        snapshot.picks_rollup,
+        summarize_picks,
+        picks_response,
+        lowerbound_dt,
+        upperbound_dt,
+        interval,
+        robot_id,
+        site,
+        pick_object,
+        group_by,
+        tz,
+        quantiles,
+    )
+
+
+def compute_tasks(
+    snapshot,
+    lowerbound_dt,
+    upperbound_dt,
+    interval,
+    robot_id,
+    site,
+    pick_object,
+    group_by=None,
+    tz=None,
+    quantiles=False,
+):
+    return compute_series(
+        snapshot.tasks,
+        snapshot.tasks_rollup,
+        summarize_tasks,
+        tasks_response,
+        lowerbound_dt,
+        upperbound_dt,
+        interval,
+        robot_id,
+        site,
+        pick_object,
+        group_by,
+        tz,
+        quantiles,
+    )
+
+
+def validate_interval(interval):
     if interval not in ["daily", "weekly", "monthly"]:
         raise HTTPException(
             status_code=400,
             detail="Invalid interval. Choose from 'daily', 'weekly', 'monthly'.",
         )
 
-    filtered_data = filter_picks_data(
-        lowerbound_dt, upperbound_dt, robot_id, site, pick_object
+
+def validate_group_by(group_by):
+    if group_by is not None and group_by not in DIMENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid group_by. Choose from {', '.join(map(repr, DIMENSIONS))}.",
+        )
+
+
+def validate_tz(tz):
+    if tz is not None and time_zone(tz) is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid tz. Use an IANA time zone name such as 'Europe/Amsterdam'.",
+        )
+
+
+def dimension_values(values):
+    # Repeated values count once, and a tuple keeps cache keys hashable
+    return tuple(dict.fromkeys(values))
+
+
+def series_media_type(request, group_by):
+    # Grouped series have no packed layout
+    if group_by is None:
+        return negotiate(request.headers.get("accept"))
+    return negotiate(request.headers.get("accept"), (JSON, COLUMNAR_JSON))
+
+
+def render_series(snapshot, compute, media_type, *args):
+    # Runs in the aggregation pool, so a process worker sends back only bytes
+    content = compute(snapshot, *args)
+    with span("serialize"):
+        return encode(content, media_type)
+
+
+async def wait_for_disconnect(request):
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def cancel_on_disconnect(request, awaitable):
+    """Await awaitable, cancelling it if the client goes away first."""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.create_task(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait(
+            {task, watcher}, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+    if task not in done:
+        # Nobody is left to read the response
+        await asyncio.wait({task})
+        return Response(status_code=499)
+    return task.result()
+
+
+async def series_body(
+    snapshot,
+    table,
+    compute,
+    media_type,
+    lowerbound_dt,
+    upperbound_dt,
+    interval,
+    robot_id,
+    site,
+    pick_object,
+    group_by,
+    tz,
+    quantiles,
+):
+    """Render compute(...) as media_type in the aggregation pool, through
+    the response cache.
+
+    The key uses the row ranges the bounds select instead of the raw
+    timestamps, so every request that selects the same rows shares one
+    entry."""
+    time_ranges = getattr(snapshot, table).time_ranges(
+        to_utc_datetime64(lowerbound_dt), to_utc_datetime64(upperbound_dt)
+    )
+    key = (
+        table,
+        media_type,
+        time_ranges,
+        interval,
+        robot_id,
+        site,
+        pick_object,
+        group_by,
+        tz,
+        quantiles,
     )
 
-    # Grouping by intervals
-    dates, unique_intervals = generate_intervals(interval, filtered_data)
-
-    # Calculate MPPH,
-    result = []
-    weights_of_pick_objects = {
-        "zucchini": 200,  # weight in grams
-        "avocado": 100,  # weight in grams
-    }
-    accumulated_tonnes = 0.0
-    accumulated_total_duration = 0
-    accumulated_picks = 0
-    for period in unique_intervals:
-        period_data = filtered_data[dates == period]
-        total_weight = 0
-        for row in period_data:
-            pick_weight = weights_of_pick_objects.get(
-                row[1], 150
-            )  # Default weight if not found
-            total_weight += pick_weight
-
-        average_pph = np.mean(period_data[:, 4].astype(np.integer))
-        total_weight_tonnes = total_weight / 1_000_000  # Convert grams to tonnes
-        accumulated_tonnes += total_weight_tonnes  # Update accumulated tonnes
-
-        total_duration = np.sum(period_data[:, 2].astype(np.integer))
-        accumulated_total_duration += total_duration  # Update accumulated duration
-
-        total_picks = np.count_nonzero(period_data[:, 4])
-        accumulated_picks += total_picks  # Update accumulated picks
-
-        result.append(
-            {
-                "date": str(period),
-                "mpph": round(average_pph),
-                "total_duration": int(total_duration),
-                "total_picks": int(total_picks),
-                "tonnes": float(f"{total_weight_tonnes:.3f}"),
-                "accumulated_total_duration": int(accumulated_total_duration),
-                "accumulated_picks": int(accumulated_picks),
-                "accumulated_tonnes": float(f"{accumulated_tonnes:.3f}"),
-            }
+    async def render():
+        return await aggregator.run(
+            snapshot_name(snapshot),
+            render_series,
+            snapshot,
+            compute,
+            media_type,
+            lowerbound_dt,
+            upperbound_dt,
+            interval,
+            robot_id,
+            site,
+            pick_object,
+            group_by,
+            tz,
+            quantiles,
         )
 
-    # Initialize lists to store values for each field
-    mpph_values = []
-    total_duration_values = []
-    total_picks_values = []
-    tonnes_values = []
-    accumulated_total_duration_values = []
-    accumulated_picks_values = []
-    accumulated_tonnes_values = []
-
-    # Populate the lists with values from each entry in the result
-    for entry in result:
-        mpph_values.append(entry["mpph"])
-        total_duration_values.append(entry["total_duration"])
-        total_picks_values.append(entry["total_picks"])
-        tonnes_values.append(entry["tonnes"])
-        accumulated_total_duration_values.append(entry["accumulated_total_duration"])
-        accumulated_picks_values.append(entry["accumulated_picks"])
-        accumulated_tonnes_values.append(entry["accumulated_tonnes"])
-
-    # Calculate min and max for each field
-    min_mpph = min(mpph_values, default=0)
-    max_mpph = max(mpph_values, default=0)
-    min_total_duration = min(total_duration_values, default=0)
-    max_total_duration = max(total_duration_values, default=0)
-    min_total_picks = min(total_picks_values, default=0)
-    max_total_picks = max(total_picks_values, default=0)
-    min_tonnes = min(tonnes_values, default=0.0)
-    max_tonnes = max(tonnes_values, default=0.0)
-    min_accumulated_total_duration = min(accumulated_total_duration_values, default=0)
-    max_accumulated_total_duration = max(accumulated_total_duration_values, default=0)
-    min_accumulated_picks = min(accumulated_picks_values, default=0)
-    max_accumulated_picks = max(accumulated_picks_values, default=0)
-    min_accumulated_tonnes = min(accumulated_tonnes_values, default=0.0)
-    max_accumulated_tonnes = max(accumulated_tonnes_values, default=0.0)
-
-    # Return result with min and max values
-    return {
-        "series": result,
-        "min_mpph": min_mpph,
-        "max_mpph": max_mpph,
-        "min_total_duration": min_total_duration,
-        "max_total_duration": max_total_duration,
-        "min_total_picks": min_total_picks,
-        "max_total_picks": max_total_picks,
-        "min_tonnes": min_tonnes,
-        "max_tonnes": max_tonnes,
-        "min_accumulated_total_duration": min_accumulated_total_duration,
-        "max_accumulated_total_duration": max_accumulated_total_duration,
-        "min_accumulated_picks": min_accumulated_picks,
-        "max_accumulated_picks": max_accumulated_picks,
-        "min_accumulated_tonnes": min_accumulated_tonnes,
-        "max_accumulated_tonnes": max_accumulated_tonnes,
-    }
+    try:
+        return await response_cache.get(key, snapshot.generation, render)
+    except QueryTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+
+def dataset_etag(snapshot, request, media_type):
+    """ETag of the response to request from snapshot: the version of the
+    dataset and a digest of the query and the media type it is sent in.
+
+    The generation only counts the refreshes of one worker, so the
+    high-water marks of the rows loaded are part of the version too."""
+    # Parameters in any order, repeated ones keeping theirs
+    query = sorted(request.query_params.multi_items(), key=lambda item: item[0])
+    digest = hashlib.blake2b(
+        repr((request.url.path, query, media_type)).encode(), digest_size=12
+    ).hexdigest()
+    version = (
+        f"{snapshot.generation}.{snapshot.picks_high_water_mark}"
+        f".{snapshot.tasks_high_water_mark}"
+    )
+    return f'"{version}-{digest}"'
+
+
+def etag_matches(request, etag):
+    """Whether the If-None-Match header of request names etag."""
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    # Weak comparison, as If-None-Match calls for
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag in tags or "*" in tags
+
+
+def validator_headers(etag):
+    # Clients may keep the response but have to revalidate it before reuse
+    return {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers=validator_headers(etag))
+
+
+async def cached_series(snapshot, etag, table, compute, media_type, *args):
+    body = await series_body(snapshot, table, compute, media_type, *args)
+    return Response(body, media_type=media_type, headers=validator_headers(etag))
+
+
+@app.get("/picks")
+async def read_mpph(
+    request: Request,
+    lowerbound_dt: datetime,
+    upperbound_dt: datetime,
+    interval: str,
+    robot_id: list[str] = Query(["all"]),
+    site: list[str] = Query(["all"]),
+    pick_object: list[str] = Query(["all"]),
+    group_by: str | None = None,
+    tz: str | None = None,
+    quantiles: bool = False,
+):
+    # robot_id, site and pick_object can be repeated to match any of the
+    # values. With group_by, one series per value of that dimension is
+    # returned as {"groups": [{group_by: value, "series": ..., ...}, ...]}.
+    # With tz, periods are days, weeks or months of that zone's calendar.
+    # With quantiles, the series also has the p50/p90/p99 of PPH and pick
+    # duration, estimated within 1%.
+    # Validate interval input
+    validate_interval(interval)
+    validate_group_by(group_by)
+    validate_tz(tz)
+
+    snapshot = dataset
+    media_type = series_media_type(request, group_by)
+    etag = dataset_etag(snapshot, request, media_type)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return await cancel_on_disconnect(
+        request,
+        cached_series(
+            snapshot,
+            etag,
+            "picks",
+            compute_picks,
+            media_type,
+            lowerbound_dt,
+            upperbound_dt,
+            interval,
+            dimension_values(robot_id),
+            dimension_values(site),
+            dimension_values(pick_object),
+            group_by,
+            tz,
+            quantiles,
+        ),
+    )
 
 
 @app.get("/tasks")
 async def read_tasks(
+    request: Request,
     lowerbound_dt: datetime,
     upperbound_dt: datetime,
     interval: str,
-    robot_id: str = "all",
-    site: str = "all",
-    pick_object: str = "all",
+    robot_id: list[str] = Query(["all"]),
+    site: list[str] = Query(["all"]),
+    pick_object: list[str] = Query(["all"]),
+    group_by: str | None = None,
+    tz: str | None = None,
+    quantiles: bool = False,
 ):
+    # robot_id, site and pick_object can be repeated to match any of the
+    # values. With group_by, one series per value of that dimension is
+    # returned as {"groups": [{group_by: value, "series": ..., ...}, ...]}.
+    # With tz, periods are days, weeks or months of that zone's calendar.
+    # With quantiles, the series also has the p50/p90/p99 of task duration,
+    # estimated within 1%.
     # Validate interval input
-    if interval not in ["daily", "weekly", "monthly"]:
+    validate_interval(interval)
+    validate_group_by(group_by)
+    validate_tz(tz)
+
+    snapshot = dataset
+    media_type = series_media_type(request, group_by)
+    etag = dataset_etag(snapshot, request, media_type)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return await cancel_on_disconnect(
+        request,
+        cached_series(
+            snapshot,
+            etag,
+            "tasks",
+            compute_tasks,
+            media_type,
+            lowerbound_dt,
+            upperbound_dt,
+            interval,
+            dimension_values(robot_id),
+            dimension_values(site),
+            dimension_values(pick_object),
+            group_by,
+            tz,
+            quantiles,
+        ),
+    )
+
+
+# Metric groups of /dashboard, each the response of the endpoint of that name
+DASHBOARD_GROUPS = {"picks": compute_picks, "tasks": compute_tasks}
+
+
+async def dashboard_response(snapshot, etag, groups, media_type, *args):
+    # Every group comes from the same dataset, and shares its cache entry with
+    # the matching /picks or /tasks request
+    bodies = await asyncio.gather(
+        *(
+            series_body(snapshot, group, DASHBOARD_GROUPS[group], media_type, *args)
+            for group in groups
+        )
+    )
+    parts = [
+        render_json(group) + b":" + body for group, body in zip(groups, bodies)
+    ]
+    return Response(
+        b"{" + b",".join(parts) + b"}",
+        media_type=media_type,
+        headers=validator_headers(etag),
+    )
+
+
+@app.get("/dashboard")
+async def read_dashboard(
+    request: Request,
+    lowerbound_dt: datetime,
+    upperbound_dt: datetime,
+    interval: str,
+    robot_id: list[str] = Query(["all"]),
+    site: list[str] = Query(["all"]),
+    pick_object: list[str] = Query(["all"]),
+    group_by: str | None = None,
+    tz: str | None = None,
+    quantiles: bool = False,
+    metrics: str = "picks,tasks",
+):
+    # Series and min/max envelopes of several metric groups for one filter set,
+    # as {"picks": <the /picks response>, "tasks": <the /tasks response>}, in
+    # either JSON shape of /picks and /tasks
+    validate_interval(interval)
+    validate_group_by(group_by)
+    validate_tz(tz)
+    groups = list(dict.fromkeys(group.strip() for group in metrics.split(",")))
+    if not all(group in DASHBOARD_GROUPS for group in groups):
         raise HTTPException(
             status_code=400,
-            detail="Invalid interval. Choose from 'daily', 'weekly', 'monthly'.",
+            detail=f"Invalid metrics. Choose from {', '.join(map(repr, DASHBOARD_GROUPS))}.",
         )
 
-    filtered_data = filter_tasks_data(
-        lowerbound_dt, upperbound_dt, robot_id, site, pick_object
+    snapshot = dataset
+    media_type = negotiate(request.headers.get("accept"), (JSON, COLUMNAR_JSON))
+    etag = dataset_etag(snapshot, request, media_type)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return await cancel_on_disconnect(
+        request,
+        dashboard_response(
+            snapshot,
+            etag,
+            groups,
+            media_type,
+            lowerbound_dt,
+            upperbound_dt,
+            interval,
+            dimension_values(robot_id),
+            dimension_values(site),
+            dimension_values(pick_object),
+            group_by,
+            tz,
+            quantiles,
+        ),
     )
 
-    # Assuming start_date is in the 6th column (index 5) of tasks_data
-    interval_format = {"daily": "D", "weekly": "W", "monthly": "M"}
-    date_interval = interval_format[interval]
-    dates = np.array(
-        [
-            np.datetime64(dt).astype(f"datetime64[{date_interval}]")
-            for dt in filtered_data[:, 6]
-        ]
+
+def live_response(
+    table,
+    summarize,
+    respond,
+    lowerbound_dt,
+    interval,
+    robot_id,
+    site,
+    pick_object,
+    tz,
+    quantiles,
+):
+    lower = to_utc_datetime64(lowerbound_dt)
+    key = (table, lower, interval, robot_id, site, pick_object, tz, quantiles)
+    events = live_hub.subscribe(
+        key,
+        table,
+        summarize,
+        respond,
+        lower,
+        interval,
+        equality_filters(robot_id, site, pick_object),
+        tz,
+        quantiles,
+    )
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    unique_intervals = np.unique(dates)
 
-    def safe_float(value, precision=2):
-        """Safely convert to float and round to avoid JSON serialization issues."""
-        try:
-            return round(float(value), precision)
-        except (ValueError, TypeError):
-            return 0.0
-
-    result = []
-    accumulating_total_tasks = 0
-    accumulating_total_duration = 0.0
-    accumulating_total_successful_picks_duration = 0.0
-    accumulating_total_successful_pick_count = 0
-    accumulating_total_unsuccessful_pick_count = 0
-    for period in unique_intervals:
-        period_data = filtered_data[dates == period]
-
-        total_tasks = len(period_data)
-        accumulating_total_tasks += total_tasks
-        total_duration = safe_float(np.nansum(period_data[:, 2].astype(np.float64)))
-        accumulating_total_duration += total_duration
-        total_successful_picks_duration = safe_float(
-            np.nansum(period_data[:, 3].astype(np.float64))
-        )
-        accumulating_total_successful_picks_duration += total_successful_picks_duration
-        total_successful_pick_count = int(
-            np.nansum(period_data[:, 4].astype(np.integer))
-        )
-        accumulating_total_successful_pick_count += total_successful_pick_count
-        total_unsuccessful_pick_count = int(
-            np.nansum(period_data[:, 5].astype(np.integer))
-        )
-        accumulating_total_unsuccessful_pick_count += total_unsuccessful_pick_count
 
-        result.append(
-            {
-                "date": str(period),
-                "total_tasks": int(total_tasks),
-                "total_duration": int(total_duration),
-                "total_successful_picks_duration": int(total_successful_picks_duration),
-                "total_successful_pick_count": int(total_successful_pick_count),
-                "total_unsuccessful_pick_count": int(total_unsuccessful_pick_count),
-                "accumulating_total_tasks": int(accumulating_total_tasks),
-                "accumulating_total_duration": int(accumulating_total_duration),
-                "accumulating_total_successful_picks_duration": int(
-                    accumulating_total_successful_picks_duration
-                ),
-                "accumulating_total_successful_pick_count": int(
-                    accumulating_total_successful_pick_count
-                ),
-                "accumulating_total_unsuccessful_pick_count": int(
-                    accumulating_total_unsuccessful_pick_count
-                ),
-            }
-        )
-        # Extract values for each field into separate lists
-        total_tasks_values = [entry["total_tasks"] for entry in result]
-        total_duration_values = [entry["total_duration"] for entry in result]
-        total_successful_picks_duration_values = [
-            entry["total_successful_picks_duration"] for entry in result
-        ]
-        total_successful_pick_count_values = [
-            entry["total_successful_pick_count"] for entry in result
-        ]
-        total_unsuccessful_pick_count_values = [
-            entry["total_unsuccessful_pick_count"] for entry in result
-        ]
-        accumulating_total_tasks_values = [
-            entry["accumulating_total_tasks"] for entry in result
-        ]
-        accumulating_total_duration_values = [
-            entry["accumulating_total_duration"] for entry in result
-        ]
-        accumulating_total_successful_picks_duration_values = [
-            entry["accumulating_total_successful_picks_duration"] for entry in result
-        ]
-        accumulating_total_successful_pick_count_values = [
-            entry["accumulating_total_successful_pick_count"] for entry in result
-        ]
-        accumulating_total_unsuccessful_pick_count_values = [
-            entry["accumulating_total_unsuccessful_pick_count"] for entry in result
-        ]
+@app.get("/picks/live")
+async def read_picks_live(
+    lowerbound_dt: datetime,
+    interval: str,
+    robot_id: list[str] = Query(["all"]),
+    site: list[str] = Query(["all"]),
+    pick_object: list[str] = Query(["all"]),
+    tz: str | None = None,
+    quantiles: bool = False,
+):
+    # Server-sent events of the /picks series from lowerbound_dt up to the
+    # newest pick: the whole series once, then the periods every refresh
+    # changes (see live.py)
+    validate_interval(interval)
+    validate_tz(tz)
+    return live_response(
+        "picks",
+        summarize_picks,
+        picks_response,
+        lowerbound_dt,
+        interval,
+        dimension_values(robot_id),
+        dimension_values(site),
+        dimension_values(pick_object),
+        tz,
+        quantiles,
+    )
 
-        # Calculate min and max for each field
-        min_total_tasks = min(total_tasks_values, default=0)
-        max_total_tasks = max(total_tasks_values, default=0)
-        min_total_duration = min(total_duration_values, default=0)
-        max_total_duration = max(total_duration_values, default=0)
-        min_total_successful_picks_duration = min(
-            total_successful_picks_duration_values, default=0
-        )
-        max_total_successful_picks_duration = max(
-            total_successful_picks_duration_values, default=0
-        )
-        min_total_successful_pick_count = min(
-            total_successful_pick_count_values, default=0
-        )
-        max_total_successful_pick_count = max(
-            total_successful_pick_count_values, default=0
-        )
-        min_total_unsuccessful_pick_count = min(
-            total_unsuccessful_pick_count_values, default=0
-        )
-        max_total_unsuccessful_pick_count = max(
-            total_unsuccessful_pick_count_values, default=0
-        )
-        min_accumulating_total_tasks = min(accumulating_total_tasks_values, default=0)
-        max_accumulating_total_tasks = max(accumulating_total_tasks_values, default=0)
-        min_accumulating_total_duration = min(
-            accumulating_total_duration_values, default=0
-        )
-        max_accumulating_total_duration = max(
-            accumulating_total_duration_values, default=0
-        )
-        min_accumulating_total_successful_picks_duration = min(
-            accumulating_total_successful_picks_duration_values, default=0
-        )
-        max_accumulating_total_successful_picks_duration = max(
-            accumulating_total_successful_picks_duration_values, default=0
+
+@app.get("/tasks/live")
+async def read_tasks_live(
+    lowerbound_dt: datetime,
+    interval: str,
+    robot_id: list[str] = Query(["all"]),
+    site: list[str] = Query(["all"]),
+    pick_object: list[str] = Query(["all"]),
+    tz: str | None = None,
+    quantiles: bool = False,
+):
+    # Server-sent events of the /tasks series, see /picks/live
+    validate_interval(interval)
+    validate_tz(tz)
+    return live_response(
+        "tasks",
+        summarize_tasks,
+        tasks_response,
+        lowerbound_dt,
+        interval,
+        dimension_values(robot_id),
+        dimension_values(site),
+        dimension_values(pick_object),
+        tz,
+        quantiles,
+    )
+
+
+async def rows_page(snapshot, etag, *args):
+    try:
+        body, _ = await run_aggregation(snapshot, page_body, *args)
+    except QueryTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    return Response(body, media_type=JSON, headers=validator_headers(etag))
+
+
+async def export_rows(
+    snapshot, table, lower, upper, equals, after, limit, descending, media_type
+):
+    # One page in memory at a time, all from the dataset the export started on
+    header = True
+    while limit is None or limit > 0:
+        size = ROWS_EXPORT_PAGE_SIZE
+        if limit is not None:
+            size = min(size, limit)
+            limit -= size
+        body, cursor = await run_aggregation(
+            snapshot,
+            page_body,
+            table,
+            lower,
+            upper,
+            equals,
+            after,
+            size,
+            descending,
+            media_type,
+            header,
         )
-        min_accumulating_total_successful_pick_count = min(
-            accumulating_total_successful_pick_count_values, default=0
+        yield body
+        if cursor is None:
+            return
+        after = parse_cursor(cursor)
+        header = False
+
+
+async def rows_response(
+    request,
+    table,
+    lowerbound_dt,
+    upperbound_dt,
+    robot_id,
+    site,
+    pick_object,
+    order,
+    limit,
+    cursor,
+):
+    if order not in ("asc", "desc"):
+        raise HTTPException(
+            status_code=400, detail="Invalid order. Choose from 'asc', 'desc'."
         )
-        max_accumulating_total_successful_pick_count = max(
-            accumulating_total_successful_pick_count_values, default=0
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit. Use 1 or more.")
+    after = None
+    if cursor is not None:
+        after = parse_cursor(cursor)
+        if after is None:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+    snapshot = dataset
+    media_type = negotiate(request.headers.get("accept"), (JSON, NDJSON, CSV))
+    lower = to_utc_datetime64(lowerbound_dt)
+    upper = to_utc_datetime64(upperbound_dt)
+    equals = equality_filters(robot_id, site, pick_object)
+    descending = order == "desc"
+    etag = dataset_etag(snapshot, request, media_type)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    if media_type == JSON:
+        size = min(limit or ROWS_PAGE_SIZE, ROWS_MAX_PAGE_SIZE)
+        return await cancel_on_disconnect(
+            request,
+            rows_page(
+                snapshot, etag, table, lower, upper, equals, after, size, descending
+            ),
         )
+    return StreamingResponse(
+        export_rows(
+            snapshot, table, lower, upper, equals, after, limit, descending, media_type
+        ),
+        media_type=media_type,
+        headers=validator_headers(etag),
+    )
 
-    # Return result with min and max values
-    return {
-        "series": result,
-        "min_total_tasks": min_total_tasks,
-        "max_total_tasks": max_total_tasks,
-        "min_total_duration": min_total_duration,
-        "max_total_duration": max_total_duration,
-        "min_total_successful_picks_duration": min_total_successful_picks_duration,
-        "max_total_successful_picks_duration": max_total_successful_picks_duration,
-        "min_total_successful_pick_count": min_total_successful_pick_count,
-        "max_total_successful_pick_count": max_total_successful_pick_count,
-        "min_total_unsuccessful_pick_count": min_total_unsuccessful_pick_count,
-        "max_total_unsuccessful_pick_count": max_total_unsuccessful_pick_count,
-        "min_accumulating_total_tasks": min_accumulating_total_tasks,
-        "max_accumulating_total_tasks": max_accumulating_total_tasks,
-        "min_accumulating_total_duration": min_accumulating_total_duration,
-        "max_accumulating_total_duration": max_accumulating_total_duration,
-        "min_accumulating_total_successful_picks_duration": min_accumulating_total_successful_picks_duration,
-        "max_accumulating_total_successful_picks_duration": max_accumulating_total_successful_picks_duration,
-        "min_accumulating_total_successful_pick_count": min_accumulating_total_successful_pick_count,
-        "max_accumulating_total_successful_pick_count": max_accumulating_total_successful_pick_count,
-    }
 
+@app.get("/picks/rows")
+async def read_pick_rows(
+    request: Request,
+    lowerbound_dt: datetime,
+    upperbound_dt: datetime,
+    robot_id: list[str] = Query(["all"]),
+    site: list[str] = Query(["all"]),
+    pick_object: list[str] = Query(["all"]),
+    order: str = "asc",
+    limit: int | None = None,
+    cursor: str | None = None,
+):
+    # The picks behind /picks in time order, see drilldown.py. JSON is one
+    # page of limit rows, and cursor is the next_cursor of the previous
+    # page. NDJSON and CSV (by Accept header) stream every row, or the first
+    # limit.
+    return await rows_response(
+        request,
+        "picks",
+        lowerbound_dt,
+        upperbound_dt,
+        dimension_values(robot_id),
+        dimension_values(site),
+        dimension_values(pick_object),
+        order,
+        limit,
+        cursor,
+    )
 
-@app.get("/robots")
-async def read_robots():
-    robots_list = [{"id": robot[0], "name": robot[1]} for robot in robots_data]
+
+@app.get("/tasks/rows")
+async def read_task_rows(
+    request: Request,
+    lowerbound_dt: datetime,
+    upperbound_dt: datetime,
+    robot_id: list[str] = Query(["all"]),
+    site: list[str] = Query(["all"]),
+    pick_object: list[str] = Query(["all"]),
+    order: str = "asc",
+    limit: int | None = None,
+    cursor: str | None = None,
+):
+    # The tasks behind /tasks, see /picks/rows
+    return await rows_response(
+        request,
+        "tasks",
+        lowerbound_dt,
+        upperbound_dt,
+        dimension_values(robot_id),
+        dimension_values(site),
+        dimension_values(pick_object),
+        order,
+        limit,
+        cursor,
+    )
+
+
+@app.get("/metrics")
+async def read_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache")
+async def read_cache_stats():
+    return response_cache.stats()
+
+
+def robots_content(snapshot):
+    robots_list = [{"id": robot[0], "name": robot[1]} for robot in snapshot.robots]
     return {"robots": robots_list}
 
 
-@app.get("/sites")
-async def read_sites():
-    sites_list = [site[0] for site in sites_data]
+def sites_content(snapshot):
+    sites_list = [site[0] for site in snapshot.sites]
     return {"sites": sites_list}
 
 
-@app.get("/objects")
-async def read_objects():
-    objects_list = [obj[0] for obj in objects_data]
+def objects_content(snapshot):
+    objects_list = [obj[0] for obj in snapshot.objects]
     return {"objects": objects_list}
 
 
+def metadata_body(snapshot, content):
+    """The JSON body of content(snapshot), rendered once per dataset."""
+    global metadata_bodies
+    if metadata_bodies[0] is not snapshot:
+        metadata_bodies = (snapshot, {})
+    bodies = metadata_bodies[1]
+    if content not in bodies:
+        # Metadata rows can hold any Postgres type
+        bodies[content] = render_json(jsonable_encoder(content(snapshot)))
+    return bodies[content]
+
+
+def metadata_response(request, content):
+    snapshot = dataset
+    etag = dataset_etag(snapshot, request, JSON)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return Response(
+        metadata_body(snapshot, content),
+        media_type=JSON,
+        headers=validator_headers(etag),
+    )
+
+
+@app.get("/robots")
+async def read_robots(request: Request):
+    return metadata_response(request, robots_content)
+
+
+@app.get("/sites")
+async def read_sites(request: Request):
+    return metadata_response(request, sites_content)
+
+
+@app.get("/objects")
+async def read_objects(request: Request):
+    return metadata_response(request, objects_content)
+
+
 @app.get("/destinations")
 async def read_destinations():
     # Add last sync end date to destinations data
+    last_syncs = await run_query(
+        fetch_last_syncs, [destination["robot_id"] for destination in destinations_data]
+    )
+    destinations = []
     for destination in destinations_data:
-        conn = psycopg2.connect(
-            dbname=PGDATABASE,
-            user=PGUSER,
-            password=PGPASSWORD,
-            host=PGHOST,
-            port=PGPORT,
-        )
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT MAX(end_date) FROM sync_log WHERE robot_id = %s",
-            (destination["robot_id"],),
-        )
-        last_sync_end_date = cur.fetchone()[0]
+        last_sync_end_date = last_syncs.get(destination["robot_id"])
         if last_sync_end_date:
-            destination["last_sync"] = last_sync_end_date.strftime("%Y-%m-%d %H:%M:%S")
+            last_sync = last_sync_end_date.strftime("%Y-%m-%d %H:%M:%S")
         else:
-            destination["last_sync"] = None
-    return destinations_data.tolist()
+            last_sync = None
+        destinations.append({**destination, "last_sync": last_sync})
+    return destinations
 
 
 @app.get("/sync")
 async def sync(robot_id: str, address: str):
     try:
-        conn = psycopg2.connect(
-            dbname=PGDATABASE,
-            user=PGUSER,
-            password=PGPASSWORD,
-            host=PGHOST,
-            port=PGPORT,
-        )
-        cur = conn.cursor()
+        await sync_scheduler.sync(robot_id, address)
+        return {"message": "success"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=describe_error(e))
 
-        # Check for the most recent end_date in sync_log for the given robot_id
-        cur.execute(
-            "SELECT MAX(end_date) FROM sync_log WHERE robot_id = %s AND status = 'success'",
-            (robot_id,),
-        )
-        last_sync_end_date = cur.fetchone()[0]
 
-        # Check if the admin server is reachable
-        admin_url = f"http://{address}:8000/admin"
-        async with httpx.AsyncClient(timeout=2.0) as client:
-            await client.get(admin_url)
+@app.get("/sync/fleet")
+async def sync_fleet():
+    # Sync every destination concurrently, poll /sync/jobs/{job_id} for progress
+    return await sync_scheduler.start_fleet_sync(destinations_data.tolist())
 
-        # Set start_date to the most recent end_date from sync_log, if it exists
-        if last_sync_end_date:
-            start_date = last_sync_end_date.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            # Default start_date if no previous syncs found
-            start_date = datetime(2018, 1, 1).strftime("%Y-%m-%d %H:%M:%S")
-
-        end_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # Backup data request
-        base_backup_url = f"http://{address}:8000/api/backup_data"
-        backup_url = f"{base_backup_url}?start_date={start_date}&end_date={end_date}&robots={robot_id}"
-        backup_response = requests.get(backup_url, timeout=3.001)
-
-        if backup_response.status_code == 200:
-            # Restore data request
-            restore_url = "http://192.168.195.194:8000/api/restore_data"
-            files = {
-                "backup_file": (
-                    "data.pickle",
-                    backup_response.content,
-                    "application/octet-stream",
-                )
-            }
-            restore_response = requests.post(restore_url, files=files, timeout=10)
-
-            if restore_response.status_code == 200:
-                # Insert a new row to the sync_log table
-                insert_query = """
-                INSERT INTO sync_log (robot_id, address, start_date, end_date, status, message) 
-                VALUES (%s, %s, %s, %s, %s, %s)
-                """
-                cur.execute(
-                    insert_query,
-                    (
-                        robot_id,
-                        address,
-                        start_date,
-                        end_date,
-                        "success",
-                        "Sync completed successfully",
-                    ),
-                )
-                conn.commit()
-
-                return {"message": "success"}
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to restore data. Server responded with status code {restore_response.status_code}: {restore_response.text}",
-                )
-        else:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to backup data. Server responded with status code {backup_response.status_code}: {backup_response.text}",
-            )
 
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail="Offline")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if conn:
-            conn.close()
+@app.get("/sync/jobs/{job_id}")
+async def read_sync_job(job_id: int):
+    job = await sync_scheduler.job_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown sync job.")
+    return job
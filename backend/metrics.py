@@ -0,0 +1,222 @@
+"""Request timing and hot-path spans, exported as Prometheus histograms.
+
+`span(stage)` times a block of work and records its duration, and
+optionally the rows it read and the buckets it produced, labelled with the
+route of the request it runs for ("" outside requests). TimingMiddleware
+times whole requests and can report a request's spans in a Server-Timing
+header. `render()` returns everything in the Prometheus text format for
+/metrics.
+
+Spans run in aggregation process workers cannot record into the parent's
+histograms; `collect` gathers them there so the parent can `replay` them.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 60, 300)
+COUNT_BUCKETS = tuple(10**power for power in range(9))
+
+# (ASGI scope, spans so far) of the request being handled
+current_request = ContextVar("current_request", default=None)
+# Spans gathered by `collect` instead of being recorded
+collected_spans = ContextVar("collected_spans", default=None)
+
+
+class Histogram:
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Label values -> ([count per bucket, +Inf last], sum)
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts, total = self.series.get(label_values) or (
+                [0] * (len(self.buckets) + 1),
+                0.0,
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.series[label_values] = (counts, total + value)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            series = [
+                (key, list(counts), total) for key, (counts, total) in self.series.items()
+            ]
+        for label_values, counts, total in sorted(series):
+            labels = ",".join(
+                f'{name}="{escape(value)}"'
+                for name, value in zip(self.labels, label_values)
+            )
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(
+                    f"{self.name}_bucket{{{labels},{le}}} {cumulative}"
+                    if labels
+                    else f"{self.name}_bucket{{{le}}} {cumulative}"
+                )
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return "\n".join(lines)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    "dashboard_request_seconds",
+    "Time to handle a request.",
+    ("method", "route", "status"),
+    SECONDS_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "dashboard_stage_seconds",
+    "Time spent in one stage of a request or background job.",
+    ("route", "stage"),
+    SECONDS_BUCKETS,
+)
+STAGE_ROWS = Histogram(
+    "dashboard_stage_rows",
+    "Rows read by one stage of a request or background job.",
+    ("route", "stage"),
+    COUNT_BUCKETS,
+)
+STAGE_BUCKETS = Histogram(
+    "dashboard_stage_buckets",
+    "Periods produced by one stage of a request.",
+    ("route", "stage"),
+    COUNT_BUCKETS,
+)
+HISTOGRAMS = (REQUEST_SECONDS, STAGE_SECONDS, STAGE_ROWS, STAGE_BUCKETS)
+
+
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        # Set inside the span when known
+        self.rows = None
+        self.buckets = None
+        self.seconds = 0.0
+
+
+@contextmanager
+def span(stage):
+    current = Span(stage)
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - started
+        spans = collected_spans.get()
+        if spans is not None:
+            spans.append((current.stage, current.seconds, current.rows, current.buckets))
+        else:
+            record(current.stage, current.seconds, current.rows, current.buckets)
+
+
+def route_of(scope):
+    # The route template rather than the path keeps the number of series
+    # bounded. The router adds it to the scope once it has matched.
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+def record(stage, seconds, rows=None, buckets=None):
+    request = current_request.get()
+    route = route_of(request[0]) if request else ""
+    STAGE_SECONDS.observe(seconds, route, stage)
+    if rows is not None:
+        STAGE_ROWS.observe(rows, route, stage)
+    if buckets is not None:
+        STAGE_BUCKETS.observe(buckets, route, stage)
+    if request:
+        request[1].append((stage, seconds))
+
+
+def collect(function, *args):
+    """Return (function(*args), the spans it ran) without recording them."""
+    spans = []
+    token = collected_spans.set(spans)
+    try:
+        return function(*args), spans
+    finally:
+        collected_spans.reset(token)
+
+
+def replay(spans):
+    for stage, seconds, rows, buckets in spans:
+        record(stage, seconds, rows, buckets)
+
+
+def render():
+    return "\n".join(histogram.render() for histogram in HISTOGRAMS) + "\n"
+
+
+class TimingMiddleware:
+    """ASGI middleware recording every HTTP request in REQUEST_SECONDS and,
+    with server_timing, listing its spans in a Server-Timing header."""
+
+    def __init__(self, app, server_timing=False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        spans = []
+        request = (scope, spans)
+        token = current_request.set(request)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    entries = [
+                        f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in spans
+                    ]
+                    entries.append(
+                        f"total;dur={(time.perf_counter() - started) * 1000:.3f}"
+                    )
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"server-timing", ", ".join(entries).encode()),
+                        ],
+                    }
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request.reset(token)
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                route_of(scope),
+                str(status),
+            )
@@ -0,0 +1,318 @@
+"""Daily rollups of the pick and task sums.
+
+A Rollup holds one cell per (day, robot_id, site, pick_object) with the
+additive sums computed by `aggregate.pick_sums` / `aggregate.task_sums`.
+Whole days of a requested range are answered from the cells, and weekly
+and monthly periods are sums of daily cells, so only the partial days at
+the edges of a range are aggregated from raw rows.
+
+Cells can also hold quantile sketches (see sketch.py), which merge the same
+way but are only read when a query asks for quantiles.
+
+Periods of a local calendar generally start within a UTC day. The cells of
+those days are split across two periods, so such days are aggregated from
+raw rows as well.
+"""
+
+import numpy as np
+
+from aggregate import (
+    INTERVALS,
+    generate_intervals,
+    grouped_sums,
+    merge_period_sums,
+    pick_sketches,
+    pick_sums,
+    task_sketches,
+    task_sums,
+    weights_by_code,
+)
+from metrics import span
+from sketch import Sketches
+
+
+DIMENSIONS = ("robot_id", "site", "pick_object")
+
+ONE_MICROSECOND = np.timedelta64(1, "us")
+ONE_DAY = np.timedelta64(1, "D")
+
+
+def summarize_picks(dictionaries, sketches=True):
+    weights = weights_by_code(dictionaries["objects"])
+
+    def summarize(columns, inverse, n):
+        sums = pick_sums(columns, inverse, n, weights)
+        if sketches:
+            sums.update(pick_sketches(columns, inverse, n))
+        return sums
+
+    return summarize
+
+
+def summarize_tasks(dictionaries, sketches=True):
+    def summarize(columns, inverse, n):
+        sums = task_sums(columns, inverse, n)
+        if sketches:
+            sums.update(task_sketches(columns, inverse, n))
+        return sums
+
+    return summarize
+
+
+class Rollup:
+    def __init__(self, days, codes, sums):
+        # Cells are sorted by day
+        self.days = days
+        self.codes = codes
+        self.sums = sums
+
+    @classmethod
+    def build(cls, columns, time_column, summarize):
+        days = columns[time_column].astype("datetime64[D]")
+        known = ~np.isnat(days)
+        if not known.all():
+            columns = {name: column[known] for name, column in columns.items()}
+            days = days[known]
+        cells, first, inverse = cell_keys(
+            days, [columns[name] for name in DIMENSIONS]
+        )
+        sums = summarize(columns, inverse, len(cells))
+        return cls(
+            days[first],
+            {name: columns[name][first] for name in DIMENSIONS},
+            sums,
+        )
+
+    def __len__(self):
+        return len(self.days)
+
+    def combine(self, other, sign=1):
+        """Return a rollup with the cells of other added (or subtracted)."""
+        days = np.concatenate((self.days, other.days))
+        codes = [
+            np.concatenate((self.codes[name], other.codes[name])) for name in DIMENSIONS
+        ]
+        cells, first, inverse = cell_keys(days, codes)
+        sums = {
+            name: np.bincount(
+                inverse,
+                weights=np.concatenate((values, sign * other.sums[name])),
+                minlength=len(cells),
+            )
+            for name, values in self.sums.items()
+            if not isinstance(values, Sketches)
+        }
+        # Cells whose rows were all subtracted disappear
+        keep = sums["rows"] > 0
+        kept_cell = np.where(keep, np.cumsum(keep) - 1, -1)[inverse]
+        first = first[keep]
+        sums = {name: values[keep] for name, values in sums.items()}
+        for name, values in self.sums.items():
+            if isinstance(values, Sketches):
+                other_values = other.sums[name]
+                if sign < 0:
+                    other_values = other_values.negated()
+                sums[name] = Sketches.merged(
+                    [
+                        (values, kept_cell[: len(self)]),
+                        (other_values, kept_cell[len(self) :]),
+                    ],
+                    (len(first),),
+                )
+        return Rollup(
+            days[first],
+            {name: column[first] for name, column in zip(DIMENSIONS, codes)},
+            sums,
+        )
+
+    def period_sums(
+        self,
+        first_day,
+        end_day,
+        codes,
+        interval,
+        group=None,
+        zone=None,
+        skip_days=None,
+        sketches=False,
+    ):
+        """Sum the cells of days first_day <= day < end_day whose code of
+        every name in codes is one of those listed for it into periods of
+        the given interval, and into groups when group is given (see
+        `period_sums`). Cells of the days in skip_days are left out, and so
+        are the sketches unless sketches is true."""
+        lo, hi = np.searchsorted(self.days, (first_day, end_day))
+        cells = slice(lo, hi)
+        if codes or skip_days is not None:
+            matches = np.ones(hi - lo, dtype=bool)
+            for name, name_codes in codes.items():
+                matches &= np.isin(self.codes[name][lo:hi], name_codes)
+            if skip_days is not None:
+                skipped = np.zeros(int((end_day - first_day) / ONE_DAY), dtype=bool)
+                skipped[(skip_days - first_day).astype(np.int64)] = True
+                matches &= ~skipped[(self.days[lo:hi] - first_day).astype(np.int64)]
+            cells = np.flatnonzero(matches) + lo
+        periods, inverse = generate_intervals(interval, self.days[cells], zone)
+        # Index of the (group, period) of every cell
+        shape = (len(periods),)
+        if group is not None:
+            name, group_of_code, n_groups = group
+            inverse = group_of_code[self.codes[name][cells]] * len(periods) + inverse
+            shape = (n_groups, len(periods))
+        n = int(np.prod(shape))
+        sums = {}
+        for name, values in self.sums.items():
+            if not isinstance(values, Sketches):
+                sums[name] = np.bincount(
+                    inverse, weights=values[cells], minlength=n
+                ).reshape(shape)
+            elif sketches:
+                segment_of = np.full(len(self), -1)
+                segment_of[cells] = inverse
+                sums[name] = values.regroup(segment_of, n).reshape(*shape)
+        return periods, sums
+
+
+def cell_keys(days, codes):
+    """np.unique over (day, *codes), returning (keys, first, inverse)."""
+    key = days.astype(np.int64)
+    for column in codes:
+        size = int(column.max()) + 1 if len(column) else 1
+        key = key * size + column
+    return np.unique(key, return_index=True, return_inverse=True)
+
+
+def whole_days(lower, upper):
+    """Return (first_day, end_day) such that the days first_day <= day <
+    end_day lie entirely within lower <= time <= upper."""
+    first_day = lower.astype("datetime64[D]")
+    if first_day < lower:
+        first_day += 1
+    end_day = (upper + ONE_MICROSECOND).astype("datetime64[D]")
+    return first_day, max(first_day, end_day)
+
+
+def split_days(zone, interval, first_day, end_day):
+    """The days first_day <= day < end_day that may hold rows of more than
+    one period of the local calendar of zone: those a period starts in
+    other than at UTC midnight, and those the UTC offset changes in."""
+    days = np.arange(first_day, end_day)
+    starts = days.astype("datetime64[us]")
+    ends = starts + (ONE_DAY - ONE_MICROSECOND)
+    unit = f"datetime64[{INTERVALS[interval]}]"
+    split = zone.local(starts).astype(unit) != zone.local(ends).astype(unit)
+    changes = zone.changes_between(starts[0], ends[-1])
+    split[(changes.astype("datetime64[D]") - first_day).astype(np.int64)] = True
+    return days[split]
+
+
+def day_ranges(days):
+    """The (lower, upper) time ranges covering sorted days, one per run of
+    consecutive days."""
+    if not len(days):
+        return []
+    breaks = np.flatnonzero(np.diff(days) != ONE_DAY) + 1
+    firsts = days[np.concatenate(([0], breaks))]
+    lasts = days[np.concatenate((breaks - 1, [len(days) - 1]))]
+    ends = (lasts + ONE_DAY).astype("datetime64[us]") - ONE_MICROSECOND
+    return list(zip(firsts.astype("datetime64[us]"), ends))
+
+
+def merge_ranges(ranges):
+    """Join (lower, upper) time ranges that touch or overlap."""
+    merged = []
+    for lower, upper in sorted(ranges):
+        if merged and lower <= merged[-1][1] + ONE_MICROSECOND:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], upper))
+        else:
+            merged.append((lower, upper))
+    return merged
+
+
+def period_sums(
+    table,
+    rollup,
+    summarize,
+    lower,
+    upper,
+    interval,
+    equals,
+    group=None,
+    zone=None,
+    sketches=False,
+):
+    """Sums per period of the rows of table with lower <= time <= upper that
+    match equals, taking whole days from the rollup.
+
+    With group = (name, group_of_code, n_groups) the sums are split by the
+    group group_of_code maps the row's code of name to, in a single
+    (group, period) reduction, and are (n_groups, n_periods) arrays. Every
+    row must map to a group.
+
+    With zone (a zones.OffsetTable) the periods follow its local calendar,
+    and the days `split_days` returns are aggregated from raw rows.
+
+    summarize must add sketches to the sums if and only if sketches is
+    true."""
+    first_day, end_day = whole_days(lower, upper)
+    parts = []
+    if first_day == end_day:
+        raw_ranges = [(lower, upper)]
+    else:
+        raw_ranges = [
+            (lower, first_day.astype(lower.dtype) - ONE_MICROSECOND),
+            (end_day.astype(upper.dtype), upper),
+        ]
+        skip_days = None
+        if zone is not None:
+            skip_days = split_days(zone, interval, first_day, end_day)
+            raw_ranges = merge_ranges(raw_ranges + day_ranges(skip_days))
+        codes = {
+            name: [table.base.encodings[name].lookup(value) for value in values]
+            for name, values in equals.items()
+        }
+        if skip_days is None or len(skip_days) < end_day - first_day:
+            with span("rollup") as stage:
+                parts.append(
+                    rollup.period_sums(
+                        first_day,
+                        end_day,
+                        codes,
+                        interval,
+                        group,
+                        zone,
+                        skip_days,
+                        sketches,
+                    )
+                )
+                stage.buckets = len(parts[0][0])
+
+    for raw_lower, raw_upper in raw_ranges:
+        if raw_lower > raw_upper and parts:
+            continue
+        with span("filter") as stage:
+            columns = table.select(raw_lower, raw_upper, equals)
+            times = columns[table.base.time_column]
+            stage.rows = len(times)
+        with span("bucket") as stage:
+            periods, inverse = generate_intervals(interval, times, zone)
+            stage.rows, stage.buckets = len(times), len(periods)
+        with span("aggregate") as stage:
+            if group is not None:
+                name, group_of_code, n_groups = group
+                sums = grouped_sums(
+                    summarize,
+                    columns,
+                    group_of_code[columns[name]],
+                    inverse,
+                    n_groups,
+                    len(periods),
+                )
+            else:
+                sums = summarize(columns, inverse, len(periods))
+            parts.append((periods, sums))
+            stage.rows = len(times)
+    with span("merge") as stage:
+        periods, sums = merge_period_sums(parts)
+        stage.buckets = len(periods)
+    return periods, sums
@@ -0,0 +1,142 @@
+"""Mergeable quantile sketches of pick and task values.
+
+A sketch is a histogram over logarithmic bins, as in DDSketch: a value v > 0
+falls in bin ceil(log(v) / log(GAMMA)), and the bin's representative value
+is within RELATIVE_ACCURACY of every value in it. Values of zero or less
+share one bin, values outside MIN_VALUE..MAX_VALUE are clamped into the
+outermost bins, and NaN values are left out.
+
+Bin counts add up, so the sketches of daily rollup cells merge exactly into
+those of weeks, months or groups, and rows are taken out of a sketch by
+subtracting their counts. A sketch never holds more than N_BINS bins.
+"""
+
+import numpy as np
+
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = np.log(GAMMA)
+
+MIN_VALUE = 1e-3
+MAX_VALUE = 1e7
+
+# Bin 0 holds values <= 0, bin i > 0 the logarithmic bin FIRST_BIN + i - 1
+FIRST_BIN = int(np.ceil(np.log(MIN_VALUE) / LOG_GAMMA))
+LAST_BIN = int(np.ceil(np.log(MAX_VALUE) / LOG_GAMMA))
+N_BINS = LAST_BIN - FIRST_BIN + 2
+
+# Merges into at most this many bins in total are done in a dense array
+DENSE_BINS = 1 << 22
+
+# Quantiles reported for every period, as (field suffix, quantile)
+QUANTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+
+
+def bins_of(values):
+    clamped = np.clip(values, MIN_VALUE, MAX_VALUE)
+    bins = np.ceil(np.log(clamped) / LOG_GAMMA).astype(np.int64) - FIRST_BIN + 1
+    return np.where(values > 0, bins, 0)
+
+
+def values_of(bins):
+    # The value with the smallest relative error to every value of the bin
+    values = 2 * GAMMA ** (bins + FIRST_BIN - 1) / (GAMMA + 1)
+    return np.where(bins > 0, values, 0.0)
+
+
+class Sketches:
+    """An array of the given shape of quantile sketches.
+
+    Only non-empty bins are stored, as one (segment, bin, count) entry each,
+    sorted by segment and bin, where segment is the flat index of the
+    sketch in the array."""
+
+    def __init__(self, segments, bins, counts, shape):
+        self.segments = segments
+        self.bins = bins
+        self.counts = counts
+        self.shape = shape
+
+    @classmethod
+    def of_values(cls, values, inverse, n):
+        """The sketches of n segments, with values[i] in segment inverse[i]."""
+        known = ~np.isnan(values)
+        keys = inverse[known].astype(np.int64) * N_BINS + bins_of(values[known])
+        keys, counts = np.unique(keys, return_counts=True)
+        return cls.from_keys(keys, counts, (n,))
+
+    @classmethod
+    def from_keys(cls, keys, counts, shape):
+        return cls(
+            (keys // N_BINS).astype(np.int32),
+            (keys % N_BINS).astype(np.int16),
+            counts.astype(np.int32),
+            shape,
+        )
+
+    @classmethod
+    def merged(cls, parts, shape):
+        """Add up sketches given as (sketches, segment_of) pairs, where
+        segment_of maps each segment of the sketches to one of the result,
+        or to -1 to leave it out."""
+        keys = []
+        counts = []
+        for sketches, segment_of in parts:
+            segments = segment_of[sketches.segments]
+            kept = segments >= 0
+            keys.append(segments[kept].astype(np.int64) * N_BINS + sketches.bins[kept])
+            counts.append(sketches.counts[kept])
+        keys = np.concatenate(keys)
+        counts = np.concatenate(counts)
+        size = int(np.prod(shape)) * N_BINS
+        if size <= 4 * len(keys) + DENSE_BINS:
+            # Few sketches, such as those of the periods of a query: add up
+            # counts in a dense array of every bin of every sketch
+            dense = np.bincount(keys, weights=counts, minlength=size)
+            keys = np.flatnonzero(dense)
+            return cls.from_keys(keys, np.rint(dense[keys]), shape)
+
+        if not (keys[1:] >= keys[:-1]).all():
+            # Parts are mostly runs of sorted keys, which a stable sort
+            # merges in close to linear time
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            counts = counts[order]
+        if len(keys):
+            firsts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+            keys = keys[firsts]
+            counts = np.add.reduceat(counts, firsts)
+        # Bins whose rows were all subtracted disappear
+        nonzero = counts != 0
+        return cls.from_keys(keys[nonzero], counts[nonzero], shape)
+
+    def regroup(self, segment_of, n):
+        return Sketches.merged([(self, segment_of)], (n,))
+
+    def negated(self):
+        return Sketches(self.segments, self.bins, -self.counts, self.shape)
+
+    def reshape(self, *shape):
+        return Sketches(self.segments, self.bins, self.counts, shape)
+
+    def quantiles(self, qs):
+        """The qs quantiles of every sketch, as an array of shape
+        self.shape + (len(qs),) that is NaN for empty sketches."""
+        n = int(np.prod(self.shape))
+        totals = np.bincount(self.segments, weights=self.counts, minlength=n)
+        cumulative = np.cumsum(self.counts)
+        # Count in the sketches before each one
+        before = np.concatenate(([0], cumulative))[
+            np.searchsorted(self.segments, np.arange(n))
+        ]
+        result = np.full((n, len(qs)), np.nan)
+        if not len(self.counts):
+            return result.reshape(self.shape + (len(qs),))
+        for i, q in enumerate(qs):
+            # The bin of the value ranked q * (count - 1) in the sketch
+            rank = before + q * (totals - 1)
+            entry = np.searchsorted(cumulative, rank, side="right")
+            entry = np.minimum(entry, len(cumulative) - 1)
+            result[:, i] = np.where(totals > 0, values_of(self.bins[entry]), np.nan)
+        return result.reshape(self.shape + (len(qs),))
@@ -0,0 +1,271 @@
+"""On-disk snapshot of a Dataset for fast cold starts.
+
+A snapshot is a directory of raw .npy files, one per column, index and
+rollup array, plus a manifest.json with the string dictionaries and the
+high-water marks. Loading memory-maps the arrays read-only, so start-up
+does not copy them into memory, and several worker processes loading the
+same snapshot share its pages through the page cache.
+
+Snapshots are written to a new directory and published by atomically
+replacing the CURRENT file that names it. The previous snapshot is kept
+until the next one is published, so readers that just read CURRENT can
+still open it.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+from rollup import DIMENSIONS, Rollup
+from sketch import Sketches
+from store import (
+    PICK_COLUMNS,
+    TASK_COLUMNS,
+    ColumnTable,
+    Dataset,
+    PositionIndex,
+    SegmentedTable,
+    StringDictionary,
+    concatenate_columns,
+)
+
+
+SNAPSHOT_VERSION = 4
+
+TABLES = {
+    "picks": (PICK_COLUMNS, "start_pick_time_utc"),
+    "tasks": (TASK_COLUMNS, "start_date_utc"),
+}
+
+# Snapshot versions kept on disk: the current one and the one before it
+KEEP_SNAPSHOTS = 2
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def compacted(table):
+    """Return table as a single ColumnTable without deleted rows."""
+    if not len(table.delta) and not len(table.base.deleted):
+        return table.base
+    base = table.base
+    columns = concatenate_columns([base.live_columns(), table.delta.live_columns()])
+    return ColumnTable(base.schema, columns, base.time_column, base.dictionaries)
+
+
+def save_snapshot(dataset, directory):
+    """Write dataset to a new snapshot under directory and make it current."""
+    os.makedirs(directory, exist_ok=True)
+    name = f"snapshot-{int(time.time() * 1000)}-{dataset.generation}"
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+
+    def save(filename, array, allow_pickle=False):
+        np.save(os.path.join(path, f"{filename}.npy"), array, allow_pickle=allow_pickle)
+
+    # Rollup sums and sketches saved, by table
+    sum_names = {}
+    sketch_names = {}
+    for table_name in TABLES:
+        table = compacted(getattr(dataset, table_name))
+        for column_name, column in table.columns.items():
+            save(f"{table_name}.{column_name}", column)
+        for column_name, index in table.indexes.items():
+            save(f"{table_name}.index.{column_name}.positions", index.positions)
+            save(f"{table_name}.index.{column_name}.offsets", index.offsets)
+
+        rollup = getattr(dataset, f"{table_name}_rollup")
+        save(f"{table_name}_rollup.days", rollup.days)
+        for dimension in DIMENSIONS:
+            save(f"{table_name}_rollup.codes.{dimension}", rollup.codes[dimension])
+        sum_names[table_name] = []
+        sketch_names[table_name] = []
+        for sum_name, values in rollup.sums.items():
+            if isinstance(values, Sketches):
+                for part in ("segments", "bins", "counts"):
+                    save(
+                        f"{table_name}_rollup.sketches.{sum_name}.{part}",
+                        getattr(values, part),
+                    )
+                sketch_names[table_name].append(sum_name)
+            else:
+                save(f"{table_name}_rollup.sums.{sum_name}", values)
+                sum_names[table_name].append(sum_name)
+
+    # Metadata rows can hold any Postgres type, so they are pickled
+    for metadata_name in ("robots", "sites", "objects"):
+        save(metadata_name, getattr(dataset, metadata_name), allow_pickle=True)
+
+    # Lets live series follow this generation without aggregating it all
+    changed_from = dataset.changed_from
+    if changed_from is not None:
+        changed_from = {
+            table_name: None if time is None else str(time)
+            for table_name, time in changed_from.items()
+        }
+
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "generation": dataset.generation,
+        "picks_high_water_mark": dataset.picks_high_water_mark,
+        "tasks_high_water_mark": dataset.tasks_high_water_mark,
+        "picks_complete_mark": dataset.picks_complete_mark,
+        "tasks_complete_mark": dataset.tasks_complete_mark,
+        "dictionaries": {
+            dictionary_name: dictionary.values
+            for dictionary_name, dictionary in dataset.dictionaries.items()
+        },
+        "sums": sum_names,
+        "sketches": sketch_names,
+        "changed_from": changed_from,
+    }
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    # Publish the snapshot, then drop older ones. Processes still mapping an
+    # old snapshot keep their pages until they let go of them.
+    current = os.path.join(directory, "CURRENT")
+    with open(f"{current}.tmp", "w") as f:
+        f.write(name)
+    os.replace(f"{current}.tmp", current)
+    # Names sort by creation time
+    snapshots = sorted(
+        entry for entry in os.listdir(directory) if entry.startswith("snapshot-")
+    )
+    for entry in snapshots[:-KEEP_SNAPSHOTS]:
+        if entry != name:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return path
+
+
+def current_snapshot(directory):
+    """Return the name of the current snapshot under directory, or None."""
+    try:
+        with open(os.path.join(directory, "CURRENT")) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def load_snapshot(directory, name=None):
+    """Load the named (by default the current) snapshot under directory, or
+    return None if there is no usable snapshot."""
+    name = name or current_snapshot(directory)
+    if name is None:
+        return None
+    try:
+        return read_snapshot(os.path.join(directory, name))
+    except (OSError, ValueError, KeyError):
+        logger.warning("Could not load snapshot %s", name, exc_info=True)
+        return None
+
+
+def read_snapshot(path):
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SNAPSHOT_VERSION:
+        logger.warning("Ignoring snapshot %s with an unknown version", path)
+        return None
+
+    def load(filename, allow_pickle=False):
+        filename = os.path.join(path, f"{filename}.npy")
+        if allow_pickle:
+            return np.load(filename, allow_pickle=True)
+        return np.load(filename, mmap_mode="r")
+
+    dictionaries = {
+        dictionary_name: StringDictionary(values)
+        for dictionary_name, values in manifest["dictionaries"].items()
+    }
+
+    tables = {}
+    rollups = {}
+    for table_name, (schema, time_column) in TABLES.items():
+        columns = {name: load(f"{table_name}.{name}") for name, _, _ in schema}
+        indexes = {
+            name: PositionIndex.restore(
+                load(f"{table_name}.index.{name}.positions"),
+                load(f"{table_name}.index.{name}.offsets"),
+            )
+            for name, _, dictionary in schema
+            if dictionary is not None
+        }
+        tables[table_name] = SegmentedTable(
+            ColumnTable(schema, columns, time_column, dictionaries, indexes)
+        )
+        days = load(f"{table_name}_rollup.days")
+        sums = {
+            sum_name: load(f"{table_name}_rollup.sums.{sum_name}")
+            for sum_name in manifest["sums"][table_name]
+        }
+        for sum_name in manifest["sketches"][table_name]:
+            sums[sum_name] = Sketches(
+                *(
+                    load(f"{table_name}_rollup.sketches.{sum_name}.{part}")
+                    for part in ("segments", "bins", "counts")
+                ),
+                (len(days),),
+            )
+        rollups[table_name] = Rollup(
+            days,
+            {
+                dimension: load(f"{table_name}_rollup.codes.{dimension}")
+                for dimension in DIMENSIONS
+            },
+            sums,
+        )
+
+    # Not in snapshots written before it was added
+    changed_from = manifest.get("changed_from")
+    if changed_from is not None:
+        changed_from = {
+            table_name: None if time is None else np.datetime64(time, "us")
+            for table_name, time in changed_from.items()
+        }
+
+    return Dataset(
+        dictionaries,
+        tables["picks"],
+        tables["tasks"],
+        load("robots", allow_pickle=True),
+        load("sites", allow_pickle=True),
+        load("objects", allow_pickle=True),
+        manifest["picks_high_water_mark"],
+        manifest["tasks_high_water_mark"],
+        manifest["generation"],
+        picks_rollup=rollups["picks"],
+        tasks_rollup=rollups["tasks"],
+        changed_from=changed_from,
+        picks_complete_mark=manifest["picks_complete_mark"],
+        tasks_complete_mark=manifest["tasks_complete_mark"],
+    )
+
+
+class LeaderLock:
+    """An exclusive, non-blocking flock on a file under the snapshot directory.
+
+    With several worker processes sharing one snapshot directory, the worker
+    holding the lock loads and refreshes the dataset and publishes it as
+    snapshots; the others only attach to those snapshots. The lock is
+    released when its holder exits, so another worker can take over."""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "LEADER")
+        self.file = None
+
+    def acquire(self):
+        if self.file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.file = lock_file
+        return True
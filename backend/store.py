@@ -0,0 +1,420 @@
+"""Columnar in-memory storage for the pick and task history."""
+
+import copy
+
+import numpy as np
+
+
+# Column layout of the picks and tasks queries in db.py, in select order.
+# Each entry is (name, dtype, dictionary); string columns are stored as int32
+# codes into the named dictionary.
+PICK_COLUMNS = (
+    ("start_pick_time_utc", "datetime64[us]", None),
+    ("pick_object", "int32", "objects"),
+    ("duration", "float64", None),
+    ("robot_id", "int32", "robots"),
+    ("pph", "float64", None),
+    ("site", "int32", "sites"),
+    ("id", "int64", None),
+)
+
+TASK_COLUMNS = (
+    ("pick_object", "int32", "objects"),
+    ("success", "bool", None),
+    ("duration", "float64", None),
+    ("successful_picks_duration", "float64", None),
+    ("successful_pick_count", "int32", None),
+    ("unsuccessful_pick_count", "int32", None),
+    ("start_date_utc", "datetime64[us]", None),
+    ("id", "int64", None),
+    ("robot_id", "int32", "robots"),
+    ("site", "int32", "sites"),
+)
+
+
+class StringDictionary:
+    """Maps strings to dense int32 codes. Code 0 is reserved for NULL."""
+
+    def __init__(self, values=None):
+        self.values = [None] if values is None else list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, values):
+        codes = self.codes
+        encoded = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = codes.get(value)
+            if code is None:
+                code = len(self.values)
+                codes[value] = code
+                self.values.append(value)
+            encoded[i] = code
+        return encoded
+
+    def lookup(self, value):
+        """Return the code of value, or -1 if it has never been seen."""
+        return self.codes.get(value, -1)
+
+    def decode(self, code):
+        return self.values[code]
+
+
+def new_dictionaries():
+    return {
+        "robots": StringDictionary(),
+        "sites": StringDictionary(),
+        "objects": StringDictionary(),
+    }
+
+
+class PositionIndex:
+    """Row positions of a dictionary-encoded column, grouped by code.
+
+    Positions of each code are kept in ascending order, so on a time-sorted
+    table they are also time-sorted and can be range-limited with
+    searchsorted."""
+
+    def __init__(self, codes, n_codes):
+        self.positions = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes, minlength=n_codes)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    @classmethod
+    def restore(cls, positions, offsets):
+        index = cls.__new__(cls)
+        index.positions = positions
+        index.offsets = offsets
+        return index
+
+    def lookup(self, code, lo, hi):
+        """Return the positions in [lo, hi) of rows with the given code."""
+        if code < 0 or code >= len(self.offsets) - 1:
+            return self.positions[:0]
+        positions = self.positions[self.offsets[code] : self.offsets[code + 1]]
+        start, stop = np.searchsorted(positions, (lo, hi))
+        return positions[start:stop]
+
+    def lookup_any(self, codes, lo, hi):
+        """Return the positions in [lo, hi) of rows with any of the given
+        distinct codes, in ascending order."""
+        if len(codes) == 1:
+            return self.lookup(codes[0], lo, hi)
+        return np.sort(np.concatenate([self.lookup(code, lo, hi) for code in codes]))
+
+
+def columns_from_rows(rows, schema, dictionaries):
+    values = list(zip(*rows)) if rows else [()] * len(schema)
+    columns = {}
+    for (name, dtype, dictionary), column_values in zip(schema, values):
+        if dictionary is not None:
+            columns[name] = dictionaries[dictionary].encode(column_values)
+        else:
+            # NULLs become NaT / NaN / False for the respective dtypes
+            columns[name] = np.array(column_values, dtype=dtype)
+    return columns
+
+
+def concatenate_columns(parts):
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+class ColumnBuilder:
+    """Collects batches of rows into typed column buffers.
+
+    Buffers double in size when full, so only one batch of rows exists as
+    Python objects at a time and loading n rows copies O(n) values."""
+
+    def __init__(self, schema, dictionaries, capacity=1024):
+        self.schema = schema
+        self.dictionaries = dictionaries
+        self.columns = {name: np.empty(capacity, dtype) for name, dtype, _ in schema}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, rows):
+        batch = columns_from_rows(rows, self.schema, self.dictionaries)
+        end = self.size + len(rows)
+        capacity = len(self.columns[self.schema[0][0]])
+        if end > capacity:
+            while end > capacity:
+                capacity *= 2
+            for column in self.columns.values():
+                column.resize(capacity, refcheck=False)
+        for name, values in batch.items():
+            self.columns[name][self.size : end] = values
+        self.size = end
+
+    def finish(self):
+        """Return the columns, trimmed to the rows appended."""
+        for column in self.columns.values():
+            column.resize(self.size, refcheck=False)
+        return self.columns
+
+
+class ColumnTable:
+    """A set of equally long typed NumPy columns sorted by a timestamp column,
+    with a PositionIndex on every dictionary-encoded column.
+
+    A ColumnTable is never modified once built. Rows are removed by deriving
+    a copy that lists their positions in `deleted`."""
+
+    def __init__(self, schema, columns, time_column, dictionaries, indexes=None):
+        self.schema = schema
+        self.time_column = time_column
+        self.dictionaries = dictionaries
+        # Column name -> dictionary, for the dictionary-encoded columns
+        self.encodings = {
+            name: dictionaries[dictionary]
+            for name, _, dictionary in schema
+            if dictionary is not None
+        }
+
+        # Columns passed together with their indexes are already sorted
+        if indexes is None:
+            # Keep rows in time order (NaT last) so ranges are contiguous slices
+            times = columns[time_column]
+            if len(times) > 1 and not np.all(times[:-1] <= times[1:]):
+                order = np.argsort(times, kind="stable")
+                columns = {name: column[order] for name, column in columns.items()}
+            indexes = {
+                name: PositionIndex(columns[name], len(dictionary))
+                for name, dictionary in self.encodings.items()
+            }
+        self.columns = columns
+        self.indexes = indexes
+        self.deleted = np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def from_rows(cls, rows, schema, time_column, dictionaries):
+        return cls(
+            schema,
+            columns_from_rows(rows, schema, dictionaries),
+            time_column,
+            dictionaries,
+        )
+
+    def __len__(self):
+        return len(self.columns[self.time_column]) - len(self.deleted)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def time_range(self, lower, upper):
+        """Return (lo, hi) such that rows lo..hi-1 have lower <= time <= upper."""
+        times = self.columns[self.time_column]
+        lo = np.searchsorted(times, lower, side="left")
+        hi = np.searchsorted(times, upper, side="right")
+        return int(lo), int(max(lo, hi))
+
+    def rows(self, lower, upper, equals):
+        """Return the rows with lower <= time <= upper whose value of every
+        name in equals is one of the distinct strings listed for it, as a
+        slice when possible or an ascending array of positions."""
+        return self.rows_in(*self.time_range(lower, upper), equals)
+
+    def rows_in(self, lo, hi, equals):
+        """Like `rows`, for the rows at positions lo..hi-1.
+
+        For equality filters the smallest matching position list is taken
+        from the indexes and checked against the remaining filters, so the
+        cost follows the size of the result rather than the size of the
+        table."""
+        if equals:
+            codes = {
+                name: [self.encodings[name].lookup(value) for value in values]
+                for name, values in equals.items()
+            }
+            candidates = [
+                (self.indexes[name].lookup_any(name_codes, lo, hi), name)
+                for name, name_codes in codes.items()
+            ]
+            rows, first = min(candidates, key=lambda candidate: len(candidate[0]))
+            for name, name_codes in codes.items():
+                if name != first and len(rows):
+                    rows = rows[np.isin(self.columns[name][rows], name_codes)]
+        else:
+            rows = slice(lo, hi)
+
+        start, stop = np.searchsorted(self.deleted, (lo, hi))
+        if start == stop:
+            return rows
+        if isinstance(rows, slice):
+            rows = np.arange(lo, hi)
+        return rows[~np.isin(rows, self.deleted[start:stop], assume_unique=True)]
+
+    def select(self, lower, upper, equals):
+        """Return the columns of the rows picked by `rows`. Without equality
+        filters or deleted rows in range the columns are zero-copy slices."""
+        rows = self.rows(lower, upper, equals)
+        return {name: column[rows] for name, column in self.columns.items()}
+
+    def live_columns(self):
+        if not len(self.deleted):
+            return self.columns
+        keep = np.ones(len(self.columns[self.time_column]), dtype=bool)
+        keep[self.deleted] = False
+        return {name: column[keep] for name, column in self.columns.items()}
+
+    def without(self, positions):
+        """Return a copy of the table with the rows at positions deleted."""
+        table = copy.copy(self)
+        table.deleted = np.union1d(self.deleted, positions)
+        return table
+
+    def decode(self, name, codes):
+        """Turn an array of codes of a dictionary column back into strings."""
+        values = np.array(self.encodings[name].values, dtype=object)
+        return values[codes]
+
+
+class SegmentedTable:
+    """A large base ColumnTable plus a small delta ColumnTable.
+
+    New rows are merged into the delta only, so a refresh copies the delta
+    instead of the whole history. Once the delta outgrows `COMPACT_RATIO`
+    of the base, both are merged into a new base."""
+
+    COMPACT_RATIO = 0.125
+
+    def __init__(self, base, delta=None):
+        self.base = base
+        self.delta = delta
+        if delta is None:
+            empty = {name: column[:0] for name, column in base.columns.items()}
+            self.delta = ColumnTable(
+                base.schema, empty, base.time_column, base.dictionaries
+            )
+
+    @classmethod
+    def from_rows(cls, rows, schema, time_column, dictionaries):
+        return cls(ColumnTable.from_rows(rows, schema, time_column, dictionaries))
+
+    @property
+    def dictionaries(self):
+        return self.base.dictionaries
+
+    def __len__(self):
+        return len(self.base) + len(self.delta)
+
+    def last_time(self):
+        """The latest time of any row, NaT if there are none."""
+        latest = []
+        for table in (self.base, self.delta):
+            times = table.columns[table.time_column]
+            # NaT sorts last
+            known = np.searchsorted(times, np.datetime64("NaT"))
+            if known:
+                latest.append(times[known - 1])
+        return max(latest) if latest else np.datetime64("NaT", "us")
+
+    def time_ranges(self, lower, upper):
+        """Row ranges of the base and delta for lower <= time <= upper.
+
+        Two bounds with the same time ranges select exactly the same rows."""
+        return self.base.time_range(lower, upper), self.delta.time_range(lower, upper)
+
+    def select(self, lower, upper, equals):
+        if not len(self.delta):
+            return self.base.select(lower, upper, equals)
+        parts = [
+            self.base.select(lower, upper, equals),
+            self.delta.select(lower, upper, equals),
+        ]
+        return concatenate_columns(parts)
+
+    def matching(self, key, values):
+        """Return the columns of the live rows whose key column is in values."""
+        base = self.base
+        positions = np.flatnonzero(np.isin(base.columns[key], values))
+        positions = positions[~np.isin(positions, base.deleted, assume_unique=True)]
+        delta_columns = self.delta.live_columns()
+        in_delta = np.isin(delta_columns[key], values)
+        return concatenate_columns(
+            [
+                {name: column[positions] for name, column in base.columns.items()},
+                {name: column[in_delta] for name, column in delta_columns.items()},
+            ]
+        )
+
+    def upsert(self, columns, key=None):
+        """Return a new table with the given rows added.
+
+        When key names a column, existing rows sharing a key value with one
+        of the new rows are replaced by the new rows."""
+        base, delta = self.base, self.delta
+        delta_columns = delta.live_columns()
+        if key is not None and len(columns[key]):
+            replaced = np.isin(base.columns[key], columns[key])
+            if replaced.any():
+                base = base.without(np.flatnonzero(replaced))
+            kept = ~np.isin(delta_columns[key], columns[key])
+            delta_columns = {name: column[kept] for name, column in delta_columns.items()}
+
+        delta = ColumnTable(
+            base.schema,
+            concatenate_columns([delta_columns, columns]),
+            base.time_column,
+            base.dictionaries,
+        )
+        if len(delta) > self.COMPACT_RATIO * max(len(base), 1):
+            merged = concatenate_columns([base.live_columns(), delta.columns])
+            return SegmentedTable(
+                ColumnTable(base.schema, merged, base.time_column, base.dictionaries)
+            )
+        return SegmentedTable(base, delta)
+
+
+class Dataset:
+    """Immutable snapshot of everything the read endpoints serve.
+
+    A refresh builds a new Dataset with a higher generation and the caller
+    swaps it in with a single assignment, so a request that grabbed a
+    Dataset never sees a half-updated state."""
+
+    def __init__(
+        self,
+        dictionaries,
+        picks,
+        tasks,
+        robots,
+        sites,
+        objects,
+        picks_high_water_mark,
+        tasks_high_water_mark,
+        generation=1,
+        picks_rollup=None,
+        tasks_rollup=None,
+        changed_from=None,
+        picks_complete_mark=None,
+        tasks_complete_mark=None,
+    ):
+        self.dictionaries = dictionaries
+        self.picks = picks
+        self.tasks = tasks
+        # Daily rollups of picks and tasks, see rollup.py
+        self.picks_rollup = picks_rollup
+        self.tasks_rollup = tasks_rollup
+        self.robots = robots
+        self.sites = sites
+        self.objects = objects
+        # Largest execution_data_pick.id / execution_data_task.id loaded
+        self.picks_high_water_mark = picks_high_water_mark
+        self.tasks_high_water_mark = tasks_high_water_mark
+        # Ids every row at or below is loaded up to. Lower than the
+        # high-water marks while rows with lower ids can still be committed.
+        if picks_complete_mark is None:
+            picks_complete_mark = picks_high_water_mark
+        if tasks_complete_mark is None:
+            tasks_complete_mark = tasks_high_water_mark
+        self.picks_complete_mark = picks_complete_mark
+        self.tasks_complete_mark = tasks_complete_mark
+        self.generation = generation
+        # Table name -> earliest time of the rows added, changed or removed
+        # since the previous generation, None for a table without changes.
+        # None as a whole when that is not known.
+        self.changed_from = changed_from
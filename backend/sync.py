@@ -0,0 +1,353 @@
+"""Backup -> restore syncing of robot data into the dashboard database."""
+
+import asyncio
+import json
+import logging
+import secrets
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+from db import (
+    fetch_last_successful_sync,
+    fetch_sync_job,
+    insert_sync_job,
+    insert_sync_log,
+    refresh_task_aggregates,
+    update_sync_job,
+)
+from metrics import record, span
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class SyncError(Exception):
+    pass
+
+
+async def download_backup(client, backup_url, chunks, chunk_size):
+    """Download a backup into the chunks queue, as its Content-Length (None
+    when not known up front), its body in chunk_size pieces and None, or
+    as an exception at any point."""
+    started = time.perf_counter()
+    try:
+        async with client.stream("GET", backup_url, timeout=3.001) as backup_response:
+            # Until the robot starts sending the backup; the download itself
+            # overlaps with the restore upload
+            record("sync.backup", time.perf_counter() - started)
+            if backup_response.status_code != 200:
+                await backup_response.aread()
+                raise SyncError(
+                    f"Failed to backup data. Server responded with status code {backup_response.status_code}: {backup_response.text}"
+                )
+            content_length = backup_response.headers.get("Content-Length")
+            if "Content-Encoding" in backup_response.headers:
+                content_length = None
+            await chunks.put(content_length)
+            async for chunk in backup_response.aiter_bytes(chunk_size):
+                await chunks.put(chunk)
+            await chunks.put(None)
+    except Exception as e:
+        await chunks.put(e)
+
+
+async def restore_backup(client, restore_url, chunks):
+    """Upload the backup download_backup puts in chunks to restore_url.
+
+    The restore upload is a hand-built multipart body consuming the queue,
+    so no full copy of the backup is ever held in memory."""
+    content_length = await chunks.get()
+    if isinstance(content_length, Exception):
+        raise content_length
+
+    # Same multipart form as files={"backup_file": ...} would produce
+    boundary = secrets.token_hex(16)
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="backup_file"; filename="data.pickle"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body():
+        yield head
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+        yield tail
+
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    # Send a Content-Length when the backup size is known up front, and fall
+    # back to chunked transfer encoding otherwise
+    if content_length:
+        headers["Content-Length"] = str(len(head) + int(content_length) + len(tail))
+
+    with span("sync.restore"):
+        restore_response = await client.post(
+            restore_url, content=body(), headers=headers, timeout=10
+        )
+    if restore_response.status_code != 200:
+        raise SyncError(
+            f"Failed to restore data. Server responded with status code {restore_response.status_code}: {restore_response.text}"
+        )
+
+
+def start_download(client, backup_url, chunk_size, max_in_flight):
+    """Start downloading a backup into a queue holding at most max_in_flight
+    bytes, and return (queue, download task)."""
+    chunks = asyncio.Queue(maxsize=max(1, max_in_flight // chunk_size))
+    download = asyncio.create_task(
+        download_backup(client, backup_url, chunks, chunk_size)
+    )
+    return chunks, download
+
+
+def sync_windows(start, end, window):
+    """Split start..end into (start, end) windows of at most window, at
+    least one."""
+    windows = []
+    while True:
+        window_end = min(start + window, end)
+        windows.append((start, window_end))
+        if window_end >= end:
+            return windows
+        start = window_end
+
+
+async def sync_robot(
+    client,
+    run_query,
+    restore_url,
+    robot_id,
+    address,
+    chunk_size,
+    max_in_flight,
+    window,
+    status=None,
+):
+    """Copy the data recorded by one robot since its last successful sync.
+
+    The data is copied in windows of at most `window` of recording time,
+    each logged in sync_log once restored, so an interrupted sync resumes
+    after the last window it finished. The backup of the next window is
+    downloaded while the current one is restored, so max_in_flight bytes
+    are split between the queues of the two."""
+    # Check for the most recent end_date in sync_log for the given robot_id
+    with span("sync.last_sync"):
+        last_sync_end_date = await run_query(fetch_last_successful_sync, robot_id)
+
+    # Check if the admin server is reachable
+    admin_url = f"http://{address}:8000/admin"
+    with span("sync.reachability"):
+        await client.get(admin_url, timeout=2.0)
+
+    # Start at the most recent end_date from sync_log, if it exists, and
+    # at a default start_date if no previous syncs were found
+    if last_sync_end_date:
+        # Naive wall-clock time, like the dates written to sync_log
+        start = last_sync_end_date.replace(tzinfo=None)
+    else:
+        start = datetime(2018, 1, 1)
+    # sync_log dates are written to the second
+    end = datetime.now().replace(microsecond=0)
+    windows = [
+        (
+            window_start.strftime("%Y-%m-%d %H:%M:%S"),
+            window_end.strftime("%Y-%m-%d %H:%M:%S"),
+        )
+        for window_start, window_end in sync_windows(start, end, window)
+    ]
+
+    # Backup data requests, each streamed into a restore data request
+    base_backup_url = f"http://{address}:8000/api/backup_data"
+    backup_urls = [
+        f"{base_backup_url}?start_date={start_date}&end_date={end_date}&robots={robot_id}"
+        for start_date, end_date in windows
+    ]
+    # Half for the window being restored and half for the one prefetched
+    queue_bytes = max_in_flight // 2
+    downloads = [start_download(client, backup_urls[0], chunk_size, queue_bytes)]
+    restored = 0
+    try:
+        for i, (start_date, end_date) in enumerate(windows):
+            if i + 1 < len(windows):
+                # Overlaps the backup of the next window with this restore
+                next_download = start_download(
+                    client, backup_urls[i + 1], chunk_size, queue_bytes
+                )
+                downloads.append(next_download)
+            await restore_backup(client, restore_url, downloads[i][0])
+
+            # Insert a new row to the sync_log table
+            with span("sync.log_insert"):
+                await run_query(
+                    insert_sync_log,
+                    robot_id,
+                    address,
+                    start_date,
+                    end_date,
+                    "success",
+                    "Sync completed successfully"
+                    if i + 1 == len(windows)
+                    else f"Synced window {i + 1} of {len(windows)}",
+                )
+            restored += 1
+            if status is not None:
+                status["message"] = f"Synced {restored} of {len(windows)} windows"
+    finally:
+        for _, download in downloads:
+            download.cancel()
+        await asyncio.gather(
+            *(download for _, download in downloads), return_exceptions=True
+        )
+        if restored:
+            # Fold the restored picks and tasks into the task aggregates
+            # right away. The data is already restored, so a failure here
+            # does not fail the sync; the next dataset refresh retries it.
+            try:
+                await run_query(refresh_task_aggregates)
+            except Exception:
+                logger.exception("Failed to refresh the task aggregates")
+
+
+class SyncScheduler:
+    """Runs robot syncs over a shared httpx.AsyncClient.
+
+    At most `concurrency` robots are synced at once, and a robot is never
+    synced twice at the same time, by this or any other worker process
+    taking the same robot_locks: a second request for it waits for the
+    first one to finish. Fleet jobs are stored in Postgres, so any worker
+    can report on them."""
+
+    # Number of finished fleet jobs kept for polling
+    MAX_JOBS = 20
+    # Seconds between attempts to take a robot lock held by another worker,
+    # and between saves of the progress of a running fleet job
+    LOCK_POLL_INTERVAL = 1.0
+    JOB_SAVE_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        client,
+        run_query,
+        robot_locks,
+        restore_url,
+        concurrency,
+        chunk_size,
+        max_in_flight,
+        window,
+    ):
+        self.client = client
+        self.run_query = run_query
+        self.robot_locks = robot_locks
+        self.restore_url = restore_url
+        # Bytes per streamed chunk, and per robot at most in memory at once,
+        # shared by the window being restored and the next one
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        # Recording time copied per backup request, as a timedelta
+        self.window = window
+        self.slots = asyncio.Semaphore(concurrency)
+        self.locks = defaultdict(asyncio.Lock)
+        # Running fleet jobs, referenced until they finish
+        self.fleet_syncs = set()
+
+    async def sync(self, robot_id, address, status=None):
+        async with self.locks[robot_id]:
+            # Held across worker processes, for as long as the sync runs
+            while not await asyncio.to_thread(self.robot_locks.try_lock, robot_id):
+                await asyncio.sleep(self.LOCK_POLL_INTERVAL)
+            try:
+                async with self.slots:
+                    if status is not None:
+                        status["status"] = "running"
+                    await sync_robot(
+                        self.client,
+                        self.run_query,
+                        self.restore_url,
+                        robot_id,
+                        address,
+                        self.chunk_size,
+                        self.max_in_flight,
+                        self.window,
+                        status,
+                    )
+            finally:
+                await asyncio.to_thread(self.robot_locks.unlock, robot_id)
+
+    async def start_fleet_sync(self, destinations):
+        """Start syncing every destination concurrently and return the job,
+        whose "status" and per-robot "robots" entries update as it runs."""
+        job = {
+            "status": "running",
+            "started": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "finished": None,
+            "robots": {
+                destination["robot_id"]: {
+                    "name": destination["name"],
+                    "status": "pending",
+                    "message": None,
+                }
+                for destination in destinations
+            },
+        }
+        job_id = await self.run_query(insert_sync_job, job, self.MAX_JOBS)
+        fleet_sync = asyncio.create_task(
+            self.run_fleet_sync(job_id, job, destinations)
+        )
+        self.fleet_syncs.add(fleet_sync)
+        fleet_sync.add_done_callback(self.fleet_syncs.discard)
+        return {"job_id": job_id, **job}
+
+    async def run_fleet_sync(self, job_id, job, destinations):
+        async def run(destination):
+            status = job["robots"][destination["robot_id"]]
+            try:
+                await self.sync(destination["robot_id"], destination["address"], status)
+                status["status"] = "success"
+            except Exception as e:
+                status["status"] = "failed"
+                status["message"] = describe_error(e)
+
+        syncs = asyncio.gather(*(run(destination) for destination in destinations))
+        # The progress is saved for the workers polling the job
+        saved = json.dumps(job)
+        while not syncs.done():
+            await asyncio.wait([syncs], timeout=self.JOB_SAVE_INTERVAL)
+            saved = await self.save_job(job_id, job, saved)
+        job["status"] = "finished"
+        job["finished"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        await self.save_job(job_id, job, saved)
+
+    async def save_job(self, job_id, job, saved):
+        """Store job if it changed since its JSON saved was stored, and
+        return the JSON stored by now."""
+        text = json.dumps(job)
+        if text == saved:
+            return saved
+        try:
+            await self.run_query(update_sync_job, job_id, job)
+        except Exception:
+            logger.exception("Failed to save sync job %s", job_id)
+            return saved
+        return text
+
+    async def job_status(self, job_id):
+        job = await self.run_query(fetch_sync_job, job_id)
+        if job is None:
+            return None
+        return {"job_id": job_id, **job}
+
+
+def describe_error(error):
+    # Connection problems and timeouts mean the robot is unreachable
+    if isinstance(error, httpx.HTTPError):
+        return "Offline"
+    return str(error)
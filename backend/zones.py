@@ -0,0 +1,106 @@
+"""UTC offsets of IANA time zones, for bucketing by local calendar.
+
+zoneinfo answers for one datetime at a time, so the offset changes of a
+zone are found once per year and kept in a table that whole columns of
+UTC timestamps are shifted with by a single searchsorted.
+"""
+
+from datetime import datetime, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+
+
+DAY_SECONDS = 86_400
+
+# Years offset tables are limited to, which bounds the cost of building one
+# for a far-reaching query range
+FIRST_YEAR = 1970
+LAST_YEAR = 2100
+
+
+def time_zone(name):
+    """Return the ZoneInfo of name, or None if there is no such zone."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def offset_seconds(zone, timestamp):
+    return int(datetime.fromtimestamp(timestamp, zone).utcoffset().total_seconds())
+
+
+@lru_cache(maxsize=1024)
+def year_changes(name, year):
+    """The UTC offset of zone name at the start of year (UTC) and every
+    change of it during the year, as [(UTC timestamp, offset seconds), ...].
+
+    The offset is sampled at every UTC midnight, and a change between two
+    samples is bisected down to the second it takes effect at."""
+    zone = ZoneInfo(name)
+    start = int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+    end = int(datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+    offset = offset_seconds(zone, start)
+    changes = [(start, offset)]
+    for day in range(start, end, DAY_SECONDS):
+        next_offset = offset_seconds(zone, day + DAY_SECONDS)
+        if next_offset == offset:
+            continue
+        lo, hi = day, day + DAY_SECONDS
+        while hi - lo > 1:
+            middle = (lo + hi) // 2
+            if offset_seconds(zone, middle) == offset:
+                lo = middle
+            else:
+                hi = middle
+        changes.append((hi, next_offset))
+        offset = next_offset
+    return changes
+
+
+class OffsetTable:
+    """The UTC offsets of a time zone from first_year to last_year, as the
+    UTC instants each offset takes effect at. Instants outside those years
+    get the offset of the nearest year."""
+
+    def __init__(self, name, first_year, last_year):
+        changes = [
+            change
+            for year in range(first_year, last_year + 1)
+            for change in year_changes(name, year)
+        ]
+        starts = np.array([start for start, _ in changes], dtype=np.int64)
+        offsets = np.array([offset for _, offset in changes], dtype=np.int64)
+        # Year starts repeat the offset in effect
+        changed = np.concatenate(([True], offsets[1:] != offsets[:-1]))
+        self.starts = (starts[changed] * 1_000_000).astype("datetime64[us]")
+        self.offsets = (offsets[changed] * 1_000_000).astype("timedelta64[us]")
+
+    @classmethod
+    def spanning(cls, name, lower, upper):
+        """The table of zone name for UTC instants lower to upper."""
+        # Local calendar years start up to a day before or after UTC ones
+        first_year = int(lower.astype("datetime64[Y]").astype(int)) + 1970 - 1
+        last_year = int(upper.astype("datetime64[Y]").astype(int)) + 1970 + 1
+        first_year = min(max(first_year, FIRST_YEAR), LAST_YEAR)
+        last_year = min(max(last_year, first_year), LAST_YEAR)
+        return cls(name, first_year, last_year)
+
+    @property
+    def is_utc(self):
+        return not self.offsets.any()
+
+    def offsets_at(self, times):
+        index = np.searchsorted(self.starts, times, side="right") - 1
+        return self.offsets[np.maximum(index, 0)]
+
+    def local(self, times):
+        """Shift UTC datetime64[us] times to local wall-clock times."""
+        return times + self.offsets_at(times)
+
+    def changes_between(self, lower, upper):
+        """The instants in lower < time <= upper at which the offset changes."""
+        lo, hi = np.searchsorted(self.starts, (lower, upper), side="right")
+        return self.starts[max(lo, 1) : hi]